@@ -6,11 +6,13 @@ import pychromecast
 import pychromecast.discovery
 import signal
 import sys
+import tempfile
 import time
 import uuid
 import websockets
 
-from .conversion import MediaServer
+from .cache import MemoryCache, SegmentCache
+from .conversion import MediaServer, TranscoderScheduler
 from .http import HTTPServer
 from .media import MediaManager
 from .rpc import Noticeboard, Server
@@ -61,6 +63,14 @@ def main():
     parser.add_argument("--media-prefix", type=str, default="/media")
     parser.add_argument("--media-url", type=str)
     parser.add_argument("--state-dir", type=str)
+    parser.add_argument("--probe-workers", type=int, default=None)
+    parser.add_argument("--cache-dir", type=str)
+    parser.add_argument("--cache-size", type=int, default=10000) # in megabytes
+    parser.add_argument("--memory-cache-size", type=int, default=256) # in megabytes, 0 to disable
+    parser.add_argument("--part-duration", type=float, default=0) # in seconds, 0 to disable low-latency playlists
+    parser.add_argument("--token-ttl", type=int, default=6 * 3600) # in seconds
+    parser.add_argument("--idle-timeout", type=int, default=1800) # in seconds, for conversion controllers
+    parser.add_argument("--encoder-limit", type=int, default=max(1, (os.cpu_count() or 1) // 4))
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.DEBUG)
@@ -87,6 +97,10 @@ def main():
     async def playlocal(data):
         url = os.path.join(args.media_url + args.media_prefix, manager.host_file(data['file_id'], data['audio_stream_index']))
 
+        if media_server.part_duration > 0:
+            # low-latency playlist, for players which support partial chunks
+            return { 'll_url': os.path.join(os.path.dirname(url), "ll.m3u8"), 'url': url }
+
         return { 'url': url }
 
 
@@ -94,7 +108,8 @@ def main():
         loop.run_until_complete(http_server.stop())
         stop_discovery()
         manager.stop()
-        media_server.stop()
+        loop.run_until_complete(manager.imdb.close())
+        loop.run_until_complete(media_server.stop())
 
         loop.stop()
 
@@ -110,12 +125,21 @@ def main():
             return ccdiscovery
         if data['name'] == 'listfiles':
             return listfiles
+        if data['name'] == 'discovery':
+            return discovery
 
     server = Server(subscribe=subscribe)
-    media_server = MediaServer()
+    cache_dir = args.cache_dir or os.path.join(args.state_dir or tempfile.gettempdir(), "opsavideo-cache")
+    memory_cache = MemoryCache(size_limit=args.memory_cache_size * 1e6) if args.memory_cache_size > 0 else None
+    cache = SegmentCache(cache_dir, size_limit=args.cache_size * 1e6, memory_cache=memory_cache)
+    cache.load()
+
+    scheduler = TranscoderScheduler(limit=args.encoder_limit)
+    media_server = MediaServer(cache=cache, scheduler=scheduler, part_duration=args.part_duration, token_ttl=args.token_ttl, idle_timeout=args.idle_timeout)
 
     ccdiscovery = Noticeboard(list())
     listfiles = Noticeboard(dict())
+    discovery = Noticeboard({ 'probed': 0, 'total': 0 })
 
     server.add_method('playfile', playfile)
     server.add_method('playlocal', playlocal)
@@ -123,12 +147,13 @@ def main():
 
     http_server = HTTPServer(server, media_server, hostname=args.hostname, port=args.port, media_prefix=args.media_prefix, static_dir=args.static)
 
-    manager = MediaManager(args.media, listfiles, loop, server=media_server, state_dir=args.state_dir)
+    manager = MediaManager(args.media, listfiles, loop, server=media_server, state_dir=args.state_dir, probe_workers=args.probe_workers, progress_noticeboard=discovery)
     manager.start()
 
     stop_discovery = discover_chromecasts(ccdiscovery, loop)
 
 
+    loop.run_until_complete(media_server.start())
     loop.run_until_complete(http_server.start())
 
     try:
@@ -0,0 +1,60 @@
+import logging
+import math
+import threading
+
+
+LOG = logging.getLogger("opsavideo.batch")
+class Batcher:
+    """
+    Coalesces items added from any thread and passes them to 'handler' as a
+    single set, either 'delay' seconds after the first pending item was added
+    or as soon as 'size' items are pending. Calls to 'handler' never overlap.
+    """
+
+    def __init__(self, handler, *, delay, size = math.inf):
+        self.handler = handler
+        self.delay = delay
+        self.size = size
+
+        self._flush_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._items = set()
+        self._pending = False
+        self._timer = None
+
+    def add(self, *items):
+        with self._lock:
+            self._items.update(items)
+            self._pending = True
+
+            if len(self._items) >= self.size:
+                flush = True
+            else:
+                flush = False
+
+                if self._timer is None:
+                    self._timer = threading.Timer(self.delay, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+        if flush:
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+
+                if not self._pending:
+                    return
+
+                items = self._items
+                self._items = set()
+                self._pending = False
+
+            try:
+                self.handler(items)
+            except Exception:
+                LOG.exception("Batch handler failed")
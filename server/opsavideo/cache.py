@@ -0,0 +1,270 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from .batch import Batcher
+
+
+LOG = logging.getLogger("opsavideo.cache")
+class SegmentCache:
+    """
+    Directory of converted segments with a size budget. Segments are evicted
+    in least recently used order once the budget is exceeded, and the index
+    is saved so that segments are reused across restarts. Segments read by
+    several clients can additionally be kept in a MemoryCache.
+    """
+
+    def __init__(self, dir_path, *, size_limit, memory_cache = None):
+        self.dir_path = dir_path
+        self.memory_cache = memory_cache
+        self.segments_path = os.path.join(dir_path, "segments")
+        self.work_path = os.path.join(dir_path, "work")
+        self.index_path = os.path.join(dir_path, "index.json")
+        self.size_limit = size_limit
+
+        # name -> size, from least to most recently used
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+        self._lock = threading.RLock()
+        self._index_writer = Batcher(lambda items: self.save_index(), delay=5)
+
+    def load(self):
+        # conversions which were running when the server stopped
+        shutil.rmtree(self.work_path, ignore_errors=True)
+
+        os.makedirs(self.segments_path, exist_ok=True)
+        os.makedirs(self.work_path, exist_ok=True)
+
+        try:
+            with open(self.index_path, 'r') as file:
+                entries = json.load(file)['entries']
+        except Exception as err:
+            LOG.info("Could not load index: %s", err)
+            entries = list()
+
+        names = set(os.listdir(self.segments_path))
+
+        with self._lock:
+            for name, size in entries:
+                if name in names:
+                    self.entries[name] = size
+                    self.size += size
+
+            # segments missing from the index, e.g. if it could not be read, are the least recently used ones by mtime
+            missing = list()
+
+            for name in names - set(self.entries.keys()):
+                try:
+                    stat = os.stat(os.path.join(self.segments_path, name))
+                except OSError:
+                    continue
+
+                missing.append((stat.st_mtime, name, stat.st_size))
+
+            for _, name, size in sorted(missing, reverse=True):
+                self.entries[name] = size
+                self.entries.move_to_end(name, last=False)
+                self.size += size
+
+            self.evict()
+
+        LOG.info("Loaded %d segments (%.1f MB)", len(self.entries), self.size / 1e6)
+
+    def save_index(self):
+        with self._lock:
+            entries = list(self.entries.items())
+
+        # replaced at once so that an interrupted write does not lose the index
+        tmp_index_path = self.index_path + ".tmp"
+
+        with open(tmp_index_path, 'w') as file:
+            json.dump({ 'entries': entries }, file)
+
+        os.replace(tmp_index_path, self.index_path)
+
+    def stop(self):
+        self._index_writer.flush()
+
+    # creates a directory where a conversion writes its segments before they are added with put()
+    def create_work_dir(self):
+        return tempfile.mkdtemp(dir=self.work_path)
+
+    # returns the path of a segment and marks it as recently used, or None if it is not cached
+    def get(self, key):
+        name = get_name(key)
+
+        with self._lock:
+            if not name in self.entries:
+                return None
+
+            self.entries.move_to_end(name)
+
+        self._index_writer.add()
+        return os.path.join(self.segments_path, name)
+
+    # returns whether a segment is cached, without marking it as recently used
+    def contains(self, key):
+        with self._lock:
+            return get_name(key) in self.entries
+
+    # returns the content of a segment if it is kept in memory, or None if it should be read from its file
+    #   'shared' segments are read by several clients and are loaded on their first access
+    async def read(self, key, *, shared = False):
+        if self.memory_cache is None:
+            return None
+
+        name = get_name(key)
+        return await self.memory_cache.get(name, os.path.join(self.segments_path, name), shared=shared)
+
+    # moves a segment into the cache and returns its new path
+    def put(self, key, filepath):
+        name = get_name(key)
+        path = os.path.join(self.segments_path, name)
+        size = os.path.getsize(filepath)
+
+        os.replace(filepath, path)
+
+        if self.memory_cache is not None:
+            self.memory_cache.discard(name)
+
+        with self._lock:
+            self.size += size - self.entries.get(name, 0)
+            self.entries[name] = size
+            self.entries.move_to_end(name)
+
+            self.evict()
+
+        self._index_writer.add()
+        return path
+
+    def evict(self):
+        with self._lock:
+            while self.size > self.size_limit and self.entries:
+                name, size = self.entries.popitem(last=False)
+                self.size -= size
+
+                if self.memory_cache is not None:
+                    self.memory_cache.discard(name)
+
+                try:
+                    os.remove(os.path.join(self.segments_path, name))
+                except OSError:
+                    pass
+
+
+# key is (file id, audio stream index, chunk index, encoding profile)
+def get_name(key):
+    (file_id, audio_channel, chunk_index, profile) = key
+    return f"{file_id}-{audio_channel}-{profile}-{chunk_index}.ts"
+
+
+class MemoryCache:
+    """
+    Content of recently read segments with a size budget, evicted in least
+    recently used order. A segment is loaded on its second access, or on
+    its first one if it is shared by several clients, so that a single
+    client reading a file once does not flush segments shared by several
+    clients. Segments are read in the default executor, and the cache is
+    otherwise only used from the event loop.
+    """
+
+    def __init__(self, *, size_limit, seen_limit = 10000):
+        self.size_limit = size_limit
+        self.seen_limit = seen_limit
+
+        # name -> content, from least to most recently used
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+        # names of segments accessed once, which are loaded on their next access
+        self.seen = collections.OrderedDict()
+
+        # name -> task reading the segment, shared by concurrent accesses
+        self.loading = dict()
+
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, name, filepath, *, shared = False):
+        data = self.entries.get(name)
+
+        if data is not None:
+            self.entries.move_to_end(name)
+            self.hits += 1
+
+            return data
+
+        self.misses += 1
+
+        if (not shared) and (not name in self.seen):
+            self.seen[name] = None
+
+            while len(self.seen) > self.seen_limit:
+                self.seen.popitem(last=False)
+
+            return None
+
+        self.seen.pop(name, None)
+
+        if not name in self.loading:
+            self.loading[name] = asyncio.ensure_future(self.load(name, filepath))
+
+        return await asyncio.shield(self.loading[name])
+
+    async def load(self, name, filepath):
+        try:
+            data = await asyncio.get_running_loop().run_in_executor(None, read_file, filepath)
+        finally:
+            # the segment was discarded while it was being read
+            discarded = self.loading.get(name) is not asyncio.current_task()
+
+            if not discarded:
+                del self.loading[name]
+
+        if (data is None) or discarded or (len(data) > self.size_limit):
+            return data
+
+        self.entries[name] = data
+        self.size += len(data)
+
+        while self.size > self.size_limit:
+            _, evicted_data = self.entries.popitem(last=False)
+            self.size -= len(evicted_data)
+
+        return data
+
+    def discard(self, name):
+        data = self.entries.pop(name, None)
+
+        if data is not None:
+            self.size -= len(data)
+
+        self.seen.pop(name, None)
+        self.loading.pop(name, None)
+
+    def get_stats(self):
+        accesses = self.hits + self.misses
+
+        return {
+            'count': len(self.entries),
+            'hit_rate': (self.hits / accesses) if accesses > 0 else None,
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': self.size,
+            'size_limit': self.size_limit
+        }
+
+
+# returns the content of a file, or None if it cannot be read
+def read_file(filepath):
+    try:
+        with open(filepath, 'rb') as file:
+            return file.read()
+    except OSError:
+        return None
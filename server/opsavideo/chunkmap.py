@@ -0,0 +1,53 @@
+class ChunkMap:
+    """
+    Set of converted chunks of a file stored as one byte per chunk, so that
+    membership is constant time and searches for missing or converted
+    chunks run over contiguous memory rather than Python objects.
+    """
+
+    _format_table = bytes.maketrans(b"\x00\x01", b"-=")
+
+    def __init__(self, size):
+        self._data = bytearray(size)
+
+    def __contains__(self, chunk_index):
+        return (0 <= chunk_index < len(self._data)) and (self._data[chunk_index] == 1)
+
+    def __len__(self):
+        return len(self._data)
+
+    def add(self, chunk_index):
+        self._data[chunk_index] = 1
+
+    def discard(self, chunk_index):
+        self._data[chunk_index] = 0
+
+    # returns the first chunk which is not converted in [start, end), or None
+    def next_missing(self, start, end = None):
+        index = self._data.find(0, start, len(self._data) if end is None else end)
+        return index if index >= 0 else None
+
+    # returns the first converted chunk in [start, end), or None
+    def next_present(self, start, end = None):
+        index = self._data.find(1, start, len(self._data) if end is None else end)
+        return index if index >= 0 else None
+
+    # returns the (start, end) ranges of converted chunks, end being excluded
+    def ranges(self):
+        ranges = list()
+        start = self.next_present(0)
+
+        while start is not None:
+            end = self.next_missing(start)
+
+            if end is None:
+                end = len(self._data)
+
+            ranges.append((start, end))
+            start = self.next_present(end)
+
+        return ranges
+
+    # returns one character per chunk, '=' if it is converted and '-' otherwise
+    def format(self):
+        return self._data.translate(self._format_table).decode("ascii")
@@ -1,45 +1,104 @@
 from aiohttp import web
 import asyncio
+import bisect
+import hashlib
 import logging
 import math
 import os
 import random
-import subprocess
-import tempfile
+import shutil
+import signal
 import time
-import threading
-import uuid
+
+from .chunkmap import ChunkMap
 
 
 LOG = logging.getLogger('opsavideo.conversion')
+
+# renditions offered in addition to the source when its resolution is higher
+RENDITIONS = [
+    { 'name': "1080p", 'height': 1080, 'video_bitrate': 5000000 },
+    { 'name': "720p", 'height': 720, 'video_bitrate': 2800000 },
+    { 'name': "480p", 'height': 480, 'video_bitrate': 1200000 }
+]
+
+# bitrate of encoded audio, included in the bandwidth of renditions (in bits per second)
+AUDIO_BITRATE = 128000
+
+
 class FileConversionController:
-    def __init__(self, filepath, duration, audio_channel):
+    def __init__(self, filepath, duration, audio_channel, *, file_id, cache, scheduler, rendition = None, audio_codec = None, audio_channels = None, video_codec = None, frame_rate = None, keyframe_times = None, part_duration = 0):
         self.audio_channel = audio_channel
+        self.audio_channels = audio_channels
+        self.audio_codec = audio_codec
+        self.cache = cache
+        self.file_id = file_id
         self.filepath = filepath
         self.duration = duration
+        self.frame_rate = frame_rate
+        self.keyframe_times = keyframe_times
+        self.rendition = rendition
+        self.scheduler = scheduler
+        self.video_codec = video_codec
 
         self.options = {
             # duration of a chunk (in seconds)
             'chunk_duration': 5,
 
-            # delay to open the playlist after it was last modified (in seconds)
-            #   0: the playlist will be opened as soon as it is modified (with at most 1s delay), with usually only one chunk
-            'mtime_delay': 10,
-
             # maximum delay for a client to wait the arrival of an existing converter to the chunk of interest (in chunks)
             #   -1: a new converter will always be started
             #   math.inf: no extra converted will ever be started
             'proximity_limit': 30,
 
-            # maximum number of converts
+            # maximum number of converts, not including range conversions
             #   math.inf: not limit
-            'converter_limit': 2
+            'converter_limit': 2,
+
+            # maximum number of range conversions, which convert a fixed range of chunks ahead of clients in parallel
+            #   they only use capacity left idle by the scheduler and are preempted first
+            #   0: ranges are never converted
+            'range_limit': 6,
+
+            # number of chunks in a range (in chunks)
+            'range_length': 6,
+
+            # number of chunks converted ahead of the playhead of each client (in chunks)
+            #   suspended conversions are resumed once a client gets this close
+            'read_ahead': 6,
+
+            # distance from the playhead of the closest client beyond which a conversion is suspended (in chunks)
+            'read_ahead_limit': 12,
+
+            # delay after which a suspended conversion which is not needed by any client is terminated (in seconds)
+            'idle_timeout': 600,
+
+            # delay after its last chunk request during which a client is counted as watching (in chunks)
+            'active_client_window': 3,
+
+            # maximum interval between keyframes of the source for its video to be copied rather than encoded (in seconds)
+            #   chunks start on the source's keyframes and can be this much longer than 'chunk_duration'
+            #   0: the video is always encoded
+            'copy_keyframe_interval': 10,
+
+            # duration of the parts of chunks listed in low-latency playlists (in seconds)
+            #   chunks are split in parts of equal duration, and are concatenated from them once complete
+            #   0: chunks are not split and low-latency playlists are not available
+            'part_duration': part_duration
         }
 
-        number_chunks = math.ceil(self.duration / self.options['chunk_duration'])
+        # start time of each chunk followed by the duration, on the source's keyframes if they are known
+        self.chunk_times = get_chunk_times(self.duration, self.options['chunk_duration'], self.keyframe_times)
+
+        (self.profile, self.codec_args) = self.select_profile()
+
+        number_chunks = len(self.chunk_times) - 1
+
+        # chunks available in the segment cache
+        self.chunks = ChunkMap(number_chunks)
 
-        self.chunks = [None for index in range(number_chunks)]
-        self.out_files = list()
+        for chunk_index in range(number_chunks):
+            if self.cache.contains(self.get_chunk_key(chunk_index)):
+                self.chunks.add(chunk_index)
 
         self.conversions = list()
         self.next_conversion_number = 0
@@ -47,16 +106,69 @@ class FileConversionController:
         self.clients = dict()
         self.chunk_requests = dict()
 
+        # client id -> { 'origin_chunk', 'origin_time', 'last_chunk', 'last_time' }
+        self.playheads = dict()
+
+        # encoded playlist, built on its first request as it only depends on the chunk layout
+        self.playlist = None
+
+        # chunk index -> paths of the complete parts of the chunk, for chunks being converted and the last converted chunk of each conversion
+        self.parts = dict()
+
+        # future resolved when a part or a chunk is added, for blocking playlist reloads
+        self.update_future = None
+
+        # longest part duration, computed on the first low-latency playlist request
+        self.part_target = None
+
+        # time of the last request to the controller, used to evict idle controllers
+        self.last_access_time = time.time()
+
+        # set once the controller is stopped, after which it does not start conversions anymore
+        self.stopped = False
+
+    # returns a name identifying the encoding settings in the segment cache, and the matching ffmpeg arguments
+    #   the video is scaled down if the controller has a rendition, and is otherwise kept at the resolution of the source
+    def select_profile(self):
+        if self.rendition is not None:
+            height = self.rendition['height']
+            video_bitrate = self.rendition['video_bitrate']
+
+            video_profile = f"x264{height}p"
+            video_args = ["-vf", f"scale=-2:{height}", "-c:v", "libx264", "-crf", "23", "-maxrate", str(video_bitrate), "-bufsize", str(video_bitrate * 2), "-preset", "veryfast", "-g", "25", "-sc_threshold", "0"]
+        elif (self.video_codec == "h264") and self.keyframe_times and (get_max_interval(self.keyframe_times) <= self.options['copy_keyframe_interval']):
+            video_profile = "copy"
+            video_args = ["-c:v", "copy"]
+        else:
+            video_profile = "x264crf21"
+            video_args = ["-c:v", "libx264", "-crf", "21", "-preset", "veryfast", "-g", "25", "-sc_threshold", "0"]
+
+        if (self.audio_codec == "aac") and (self.audio_channels is not None) and (self.audio_channels <= 2):
+            audio_profile = "copy"
+            audio_args = ["-c:a", "copy"]
+        else:
+            audio_profile = "aac128k"
+            audio_args = ["-c:a", "aac", "-b:a", str(AUDIO_BITRATE), "-ac", "2"]
+
+        # chunks have different boundaries when they are placed on keyframes
+        #   "-kf2" skips chunks cut on keyframe times rounded to the millisecond, which could be a whole GOP off
+        layout_profile = "-kf2" if self.keyframe_times else ""
+
+        return f"{video_profile}-{audio_profile}{layout_profile}", video_args + audio_args
+
+    def get_chunk_key(self, chunk_index):
+        return (self.file_id, self.audio_channel, chunk_index, self.profile)
+
     def add_client_chunk(self, client_id, chunk_index):
-        if self.chunks[chunk_index] is not None:
-            return
+        if not chunk_index in self.chunks:
+            LOG.info("[cl. %s] Adding chunk %d", client_id, chunk_index)
 
-        LOG.info("[cl. %s] Adding chunk %d", client_id, chunk_index)
+            if not client_id in self.clients:
+                self.clients[client_id] = set()
 
-        if not client_id in self.clients:
-            self.clients[client_id] = set()
+            self.clients[client_id].add(chunk_index)
 
-        self.clients[client_id].add(chunk_index)
+        # the read-ahead window of the client moved even if the chunk is already converted
         self.manage_conversions()
 
     def remove_client_chunk(self, client_id, chunk_index):
@@ -74,326 +186,1269 @@ class FileConversionController:
         self.manage_conversions()
 
 
-    def manage_conversions(self):
-        target_chunk_indices = set()
+    # forgets the requests and the playhead of a client whose token expired
+    def remove_client(self, client_id):
+        self.clients.pop(client_id, None)
+        self.playheads.pop(client_id, None)
 
-        for client_id, client_chunks in self.clients.items():
-            for client_chunk_index in sorted(client_chunks):
-                for target_chunk_index in target_chunk_indices:
-                    distance = target_chunk_index - client_chunk_index
+        self.manage_conversions()
 
-                    if distance >= 0 and distance < 10:
-                        break
-                else:
-                    target_chunk_indices.add(client_chunk_index)
+    # records a chunk request from a client, restarting the playback estimate when the client seeks
+    def update_playhead(self, client_id, chunk_index):
+        state = self.playheads.get(client_id)
 
+        if (state is None) or not (state['last_chunk'] <= chunk_index <= state['last_chunk'] + 1):
+            state = { 'origin_chunk': chunk_index, 'origin_time': time.time(), 'last_chunk': chunk_index, 'last_time': None }
+            self.playheads[client_id] = state
 
-        current_time = time.time()
-        new_conv_chunk_indices = target_chunk_indices.copy()
+        state['last_chunk'] = chunk_index
+        state['last_time'] = time.time()
 
-        for conv in self.conversions:
-            for target_chunk_index in target_chunk_indices:
-                distance = target_chunk_index - conv['time']
+    # returns the number of clients which requested a chunk recently, as tokens are kept long after their client stopped watching
+    def get_active_client_count(self):
+        min_time = time.time() - self.options['active_client_window'] * self.options['chunk_duration']
+        return len([state for state in self.playheads.values() if state['last_time'] >= min_time])
 
-                if distance >= 0 and distance < 10:
-                    conv['last_active_time'] = None
-                    new_conv_chunk_indices.discard(target_chunk_index)
-                    break
-            else:
-                if conv['last_active_time'] is None:
-                    LOG.info("[#%d] Putting in standby due to inactivity", conv['number'])
-                    conv['last_active_time'] = time.time()
-                elif current_time - conv['last_active_time'] > 5:
-                    LOG.info("[#%d] Terminating due to inactivity", conv['number'])
-                    self.stop_conv(conv)
+    # returns the estimated playback position of a client (in chunks), assuming playback started with its first contiguous request
+    #   the estimate stops at the last requested chunk, so that it does not move forward while playback is paused
+    def get_playhead(self, client_id, current_time):
+        state = self.playheads.get(client_id)
 
-        for chunk_index in new_conv_chunk_indices:
-            self.start_conversion(chunk_index)
+        if state is None:
+            return 0
 
+        return min(state['last_chunk'], state['origin_chunk'] + (current_time - state['origin_time']) / self.options['chunk_duration'])
 
-    def start_conversion(self, start_chunk_index):
+    # returns the first chunk which is not converted in the read-ahead window of a client, or None
+    def get_read_ahead_chunk(self, client_id, playhead):
+        start_chunk_index = self.playheads[client_id]['last_chunk'] + 1
+        end_chunk_index = min(len(self.chunks), math.floor(playhead) + self.options['read_ahead'] + 1)
+
+        if start_chunk_index >= end_chunk_index:
+            return None
+
+        return self.chunks.next_missing(start_chunk_index, end_chunk_index)
+
+    def manage_conversions(self):
         """
-        frame=75959 fps=125 q=26.0 size=N/A time=00:00:30.46 bitrate=N/A speed=5.02x
-        fps=125.16
-        stream_0_0_q=26.0
-        bitrate=N/A
-        total_size=N/A
-        out_time_us=30464578
-        out_time_ms=30464578
-        out_time=00:00:30.464578
-        dup_frames=0
-        drop_frames=0
-        speed=5.02x
-        progress=continue
+        Groups the chunks requested by clients, and the first missing chunk of
+        the read-ahead window of each client, into targets, each target being
+        the first chunk of a range of 'proximity_limit' chunks. Targets
+        covered by an existing conversion keep it active, while the others
+        are sent to the scheduler as requests for new conversions, with a
+        priority equal to the number of chunks before a client needs them.
+
+        Conversions which get more than 'read_ahead_limit' chunks ahead of
+        the closest client, or which are not needed anymore, are suspended
+        rather than terminated, and are resumed through the scheduler once a
+        client's read-ahead window reaches them again.
         """
-        start_time = start_chunk_index * self.options['chunk_duration']
 
-        out_id = uuid.uuid4()
-        out_filepath_path = os.path.join(tempfile.gettempdir(), str(out_id))
-        out_filepath_playlist = out_filepath_path + ".m3u8"
-        out_filepath_media = out_filepath_path + ".ts"
+        if self.stopped:
+            return
 
-        thread_ready = threading.Event()
+        current_time = time.time()
+        proximity_limit = self.options['proximity_limit']
 
-        def handler():
-            conv_number = self.next_conversion_number
-            LOG.info("[#%d] Starting conversion from chunk %d to '%s'", conv_number, start_chunk_index, out_filepath_media)
+        playheads = {client_id: self.get_playhead(client_id, current_time) for client_id in self.playheads}
+        clients = {client_id: set(client_chunks) for client_id, client_chunks in self.clients.items()}
 
-            # -ss <t>
-            #   set start time
-            # -map 0:v0 -map 0:<x>
-            #   select audio and video streams
-            # -c:v libx264 -crf 21 -preset veryfast -g 25 -sc_threshold 0
-            #   set video codec
-            # -c:a aac -b:a 128k -ac 2
-            #   set audio codec (keep -ac ?)
-            # -copyts -timecode <t>
-            #   set offset output timecodes
-            # -f hls -hls_time <t> -hls_playlist_type event -hls_flags single_file
-            #   set output format
-            # -progress - -y
-            #   set output information format
-            process = subprocess.Popen(f"ffmpeg -ss {start_time} -i '{self.filepath}' -map 0:v:0 -map 0:{self.audio_channel} -c:v libx264 -crf 21 -preset veryfast -g 25 -sc_threshold 0 -c:a aac -b:a 128k -ac 2 -copyts -timecode {start_time} -f hls -hls_time {self.options['chunk_duration']} -hls_playlist_type event -hls_flags single_file -progress - -y {out_filepath_playlist}", shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-            conv = {
-                'number': conv_number,
-                'last_active_time': None,
-                'process': process,
-                'thread': threading.current_thread(),
-                'time': start_chunk_index
-            }
+        for client_id, playhead in playheads.items():
+            read_ahead_chunk_index = self.get_read_ahead_chunk(client_id, playhead)
+
+            if read_ahead_chunk_index is not None:
+                clients.setdefault(client_id, set()).add(read_ahead_chunk_index)
 
-            self.next_conversion_number += 1
+        # list of (chunk index, priority) for all requested chunks, in order
+        requested_chunks = sorted((chunk_index, max(0, chunk_index - playheads.get(client_id, 0))) for client_id, client_chunks in clients.items() for chunk_index in client_chunks)
 
-            self.conversions.append(conv)
-            self.out_files.append(out_filepath_media)
+        # target chunk index -> priority, built in a single pass over the requested chunks
+        targets = dict()
+        target_chunk_index = None
 
-            thread_ready.set()
+        for chunk_index, priority in requested_chunks:
+            if (target_chunk_index is not None) and (chunk_index - target_chunk_index < proximity_limit):
+                targets[target_chunk_index] = min(targets[target_chunk_index], priority)
+            else:
+                target_chunk_index = chunk_index
+                targets[target_chunk_index] = priority
 
-            last_chunks_length = 0
-            last_mtime = None
 
-            data = dict()
-            for line in iter(process.stdout.readline, b''):
-                [key, value] = line.decode("utf-8").strip().split("=", 2)
-                data[key] = value
+        # conversions and playheads sorted by position, to be searched with bisect
+        convs = sorted(self.conversions, key=lambda conv: conv['time'])
+        conv_times = [conv['time'] for conv in convs]
+        sorted_playheads = sorted(playheads.values())
 
-                if key != "progress" or int(data['out_time_us']) < self.options['chunk_duration'] * 1e6 * 1.5:
-                    continue
+        # conversion number -> priorities of the targets covered by the conversion
+        covered_priorities = {conv['number']: list() for conv in convs}
+        new_targets = dict()
+
+        for target_chunk_index, priority in targets.items():
+            conv = self.find_covering_conv(convs, conv_times, target_chunk_index)
+
+            if conv is not None:
+                covered_priorities[conv['number']].append(priority)
+            else:
+                new_targets[target_chunk_index] = priority
+
+        standby_convs = list()
+
+        # list of (priority, chunk index, end chunk index) for suspended conversions to be resumed
+        resume_requests = list()
+
+        # distance from the closest client within which range conversions are kept running (in chunks)
+        range_window = (self.options['range_limit'] + 1) * self.options['range_length']
+
+        for conv in convs:
+            conv_priorities = covered_priorities[conv['number']]
+
+            # number of chunks between the conversion and the closest client behind it
+            playhead_index = bisect.bisect_right(sorted_playheads, conv['time']) - 1
+            lead = (conv['time'] - sorted_playheads[playhead_index]) if playhead_index >= 0 else math.inf
+
+            if conv['end'] is not None:
+                active = conv_priorities or (lead <= range_window)
+            else:
+                active = conv_priorities or (not conv['suspended'] and lead <= self.options['read_ahead_limit'])
+
+            if active:
+                conv['last_active_time'] = None
+                conv['priority'] = min(conv_priorities + [lead])
+
+                if conv['suspended']:
+                    resume_requests.append((conv['priority'], conv['time'], conv['end']))
+
+                continue
+
+            conv['priority'] = math.inf
+
+            if conv['last_active_time'] is None:
+                conv['last_active_time'] = current_time
+
+                # checks again once the conversion could be terminated, as no client may request anything until then
+                asyncio.get_event_loop().call_later(self.options['idle_timeout'] + 1, self.manage_conversions)
+            elif current_time - conv['last_active_time'] > self.options['idle_timeout']:
+                LOG.info("[#%d] Terminating due to inactivity", conv['number'])
+                self.stop_conv(conv)
+                continue
+
+            if not conv['suspended']:
+                if lead < math.inf:
+                    LOG.info("[#%d] Suspending %.1f chunks ahead of the closest client", conv['number'], lead)
+                else:
+                    LOG.info("[#%d] Suspending due to inactivity", conv['number'])
+
+                self.suspend_conv(conv)
+
+            if conv['end'] is None:
+                standby_convs.append(conv)
+
+        requests = sorted((priority, chunk_index, None) for chunk_index, priority in new_targets.items())
+
+        # conversions in standby are stopped to make room for new ones within 'converter_limit'
+        while requests and standby_convs and len(self.get_open_convs()) + len(requests) > self.options['converter_limit']:
+            conv = standby_convs.pop()
+            LOG.info("[#%d] Terminating to make room for a new conversion", conv['number'])
+            self.stop_conv(conv)
+
+        available_count = max(0, self.options['converter_limit'] - len(self.get_open_convs()))
+        requests = resume_requests + requests[0:available_count]
+
+        if self.scheduler.get_idle_count() > 0:
+            requests += self.get_range_requests(playheads, convs, conv_times, new_targets)
+
+        requests.sort(key=lambda request: request[0:2])
+
+        self.scheduler.update(self, [(chunk_index, priority, end_chunk_index) for priority, chunk_index, end_chunk_index in requests])
+
+    # returns the conversion which will reach a chunk first, or None if no conversion is close enough
+    #   'convs' are sorted by position, and a conversion is close enough if it is less than 'proximity_limit' chunks before the chunk and does not end before it
+    def find_covering_conv(self, convs, conv_times, chunk_index):
+        conv_index = bisect.bisect_right(conv_times, chunk_index) - 1
+
+        while (conv_index >= 0) and (chunk_index - conv_times[conv_index] < self.options['proximity_limit']):
+            conv = convs[conv_index]
+
+            if (conv['end'] is None) or (chunk_index < conv['end']):
+                return conv
 
-                if not os.path.isfile(out_filepath_playlist):
-                    LOG.info("[#%d] Playlist does not exist, will try again later", conv_number)
+            conv_index -= 1
+
+        return None
+
+    # returns conversions which are not range conversions
+    def get_open_convs(self):
+        return [conv for conv in self.conversions if conv['end'] is None]
+
+    def get_range_requests(self, playheads, convs, conv_times, new_targets):
+        """
+        Splits the window of 'range_limit' ranges of 'range_length' chunks
+        following the first range ahead of each client, which is left to the
+        conversion serving the client, and returns a request for each range
+        with missing chunks not covered by a conversion, as a list of
+        (priority, chunk index, end chunk index).
+        """
+
+        range_length = self.options['range_length']
+        range_count = self.options['range_limit'] - (len(self.conversions) - len(self.get_open_convs()))
+
+        requests = list()
+        requested_chunks = set(new_targets.keys())
+
+        for playhead in sorted(playheads.values()):
+            window_start = math.floor(playhead) + range_length
+            window_end = min(len(self.chunks), window_start + self.options['range_limit'] * range_length)
+
+            for range_start in range(window_start, window_end, range_length):
+                if len(requests) >= range_count:
+                    return requests
+
+                range_end = min(window_end, range_start + range_length)
+                chunk_index = self.chunks.next_missing(range_start, range_end)
+
+                if (chunk_index is None) or (chunk_index in requested_chunks) or (self.find_covering_conv(convs, conv_times, chunk_index) is not None):
                     continue
 
-                mtime = os.path.getmtime(out_filepath_playlist)
+                requests.append((chunk_index - playhead, chunk_index, range_end))
+                requested_chunks.add(chunk_index)
 
-                if last_mtime is None or mtime - last_mtime > self.options['mtime_delay']:
+        return requests
 
 
-                    last_mtime = mtime
-                    added_chunks = list()
+    # starts a conversion, or resumes the suspended conversion at this chunk
+    #   conversions with an end chunk index are range conversions, and stop before that chunk
+    def start_conversion(self, start_chunk_index, priority = 0, end_chunk_index = None):
+        for conv in self.conversions:
+            if conv['suspended'] and conv['time'] == start_chunk_index:
+                LOG.info("[#%d] Resuming at chunk %d", conv['number'], start_chunk_index)
+
+                conv['last_active_time'] = None
+                conv['priority'] = priority
+                self.resume_conv(conv)
+
+                return conv
+
+        conv = {
+            'end': end_chunk_index,
+            'number': self.next_conversion_number,
+            'last_active_time': None,
+            'priority': priority,
+            'process': None,
+            'stopped': False,
+            'suspended': False,
+            'task': None,
+            'time': start_chunk_index,
+
+            # paths of the complete parts of the chunk being converted
+            'parts': list()
+        }
+
+        self.next_conversion_number += 1
+        self.conversions.append(conv)
 
-                    with open(out_filepath_playlist) as file:
-                        key = "#EXT-X-BYTERANGE:"
-                        chunks_lines = [line for line in file.readlines() if line.startswith(key)]
+        conv['task'] = asyncio.ensure_future(self.run_conversion(conv))
 
-                        for line in chunks_lines[last_chunks_length:]:
-                            [chunk_size, chunk_offset] = line[len(key):].rstrip("\n").split("@")
-                            added_chunks.append((int(chunk_offset), int(chunk_size)))
+        return conv
 
-                        last_chunks_length = len(chunks_lines)
+    async def run_conversion(self, conv):
+        """
+        ffmpeg writes one line to its standard output for each chunk, as soon
+        as the chunk is complete:
+
+        12.ts,60.000000,65.040000
+        13.ts,65.040000,70.000000
+        """
+        conv_number = conv['number']
+        start_chunk_index = conv['time']
+        start_time = self.chunk_times[start_chunk_index]
+        end_chunk_index = conv['end'] if conv['end'] is not None else len(self.chunks)
+
+        # absolute end time of each chunk but the last one, as timestamps are kept with -copyts
+        segment_times = ",".join(str(chunk_time) for chunk_time in self.chunk_times[start_chunk_index + 1:end_chunk_index])
+
+        # with parts, ffmpeg writes one file per part and may cut them between keyframes, as chunks are cut on keyframes anyway
+        use_parts = self.options['part_duration'] > 0
+
+        if use_parts:
+            # end time of each part but the last one
+            part_times = [part_time for chunk_index in range(start_chunk_index, end_chunk_index) for part_time in self.get_part_times(chunk_index)[1:]]
+            split_times = ",".join(str(part_time) for part_time in part_times[:-1])
+            part_args = ["-break_non_keyframes", "1"]
+        else:
+            split_times = segment_times
+            part_args = list()
+
+        # range conversions stop at the end of their last chunk
+        #   the end time is absolute as timestamps are kept with -copyts, while -t would be compared to them when streams are copied
+        duration_args = ["-to", str(self.chunk_times[end_chunk_index])] if conv['end'] is not None else list()
+
+        # chunks and parts are cut on the first frame within half a frame of their start time, as frame times are not exact
+        #   a single chunk or part has no split point, and ffmpeg rejects an empty list of times and otherwise cuts every 2 seconds
+        if split_times:
+            split_args = ["-segment_times", split_times, "-segment_time_delta", str(0.5 / (self.frame_rate or 50))]
+        else:
+            split_args = ["-segment_time", str(math.ceil(self.duration) + 1)]
+
+        # encoded video gets keyframes at the start of each chunk, so that chunks are cut at the same times in all renditions
+        keyframe_args = ["-force_key_frames", segment_times] if segment_times and (self.codec_args[1] != "copy") else list()
+
+        out_dirpath = self.cache.create_work_dir()
+        out_filepath_segments = os.path.join(out_dirpath, "%d.ts")
+
+        LOG.info("[#%d] Starting conversion from chunk %d to '%s' with profile %s", conv_number, start_chunk_index, out_dirpath, self.profile)
+        self.log_chunks(conv)
+
+        try:
+            # -ss <t>
+            #   set start time, which is a keyframe of the source if keyframes are known
+            # -map 0:v0 -map 0:<x>
+            #   select audio and video streams
+            # -c:v libx264 -crf 21 -preset veryfast -g 25 -sc_threshold 0 or -c:v copy
+            #   set video codec
+            # -c:a aac -b:a 128k -ac 2 or -c:a copy
+            #   set audio codec (keep -ac ?)
+            # -force_key_frames <t,...>
+            #   start each chunk with a keyframe when the video is encoded
+            # -to <t>
+            #   set end time of range conversions
+            # -copyts -timecode <t>
+            #   set offset output timecodes
+            # -f segment -segment_format mpegts -segment_times <t,...> -segment_time_delta <d> or -segment_time <d> -segment_start_number <n>
+            #   set output format, with one file per chunk named after the chunk's index, or one file per part
+            # -break_non_keyframes 1
+            #   cut parts between keyframes
+            # -segment_list pipe:1 -segment_list_type csv -segment_list_flags +live
+            #   write each completed chunk to stdout
+            # -loglevel error -nostats -y
+            #   only log errors
+            process = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-ss", str(start_time), "-i", self.filepath,
+                "-map", "0:v:0", "-map", f"0:{self.audio_channel}",
+                *self.codec_args,
+                *keyframe_args,
+                *duration_args,
+                "-copyts", "-timecode", str(start_time),
+                "-f", "segment", "-segment_format", "mpegts", *split_args, "-segment_start_number", str(start_chunk_index), *part_args,
+                "-segment_list", "pipe:1", "-segment_list_type", "csv", "-segment_list_flags", "+live",
+                "-loglevel", "error", "-nostats", "-y", out_filepath_segments,
+                stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE)
+
+            conv['process'] = process
+
+            # stopped or suspended while the process was starting
+            if conv['stopped']:
+                process.kill()
+            elif conv['suspended']:
+                process.send_signal(signal.SIGSTOP)
+
+            async for line in process.stdout:
+                chunk_filename = line.decode("utf-8").strip().split(",")[0]
+
+                if not chunk_filename:
+                    continue
 
-                    LOG.info("[#%d] Adding %d chunks", conv_number, len(added_chunks))
-                    cont_conversion = self.conv_add_chunks(conv, added_chunks)
+                if use_parts:
+                    cont_conversion = await self.conv_add_part(conv, os.path.join(out_dirpath, chunk_filename))
+                else:
+                    LOG.info("[#%d] Adding chunk '%s'", conv_number, chunk_filename)
+                    cont_conversion = self.conv_add_chunks(conv, [os.path.join(out_dirpath, chunk_filename)])
 
-                    if not cont_conversion:
-                        break
+                if not cont_conversion:
+                    break
 
-            process.wait()
+            await process.wait()
             LOG.info("[#%d] Process exited with code %d", conv_number, process.returncode)
+            self.log_chunks(conv)
+        except Exception:
+            LOG.exception("[#%d] Conversion failed", conv_number)
+        finally:
+            # the process is still running if the conversion failed or was cancelled
+            if (conv['process'] is not None) and (conv['process'].returncode is None):
+                if conv['suspended']:
+                    self.resume_conv(conv)
+
+                self.stop_conv(conv)
 
             if conv in self.conversions:
                 self.conversions.remove(conv)
 
+            # parts are removed with the directory of the conversion
+            for chunk_index, part_filepaths in list(self.parts.items()):
+                if part_filepaths and (os.path.dirname(part_filepaths[0]) == out_dirpath):
+                    del self.parts[chunk_index]
 
+            # segments which were not moved to the cache
+            shutil.rmtree(out_dirpath, ignore_errors=True)
 
-        thread = threading.Thread(target=handler)
-        thread.start()
-
-        thread_ready.wait()
+            self.scheduler.release()
 
     def conv_add_chunks(self, conv, chunks):
         last_chunk_index = conv['time']
 
-        for chunk_rel_index, (chunk_offset, chunk_size) in enumerate(chunks):
+        for chunk_rel_index, chunk_filepath in enumerate(chunks):
             chunk_index = last_chunk_index + chunk_rel_index
 
-            if self.chunks[chunk_index] is not None:
+            if chunk_index in self.chunks:
                 LOG.info("[#%d] Dropping conversion after encountering a converted chunk", conv['number'])
                 self.stop_conv(conv)
 
                 return False
 
-            self.chunks[chunk_index] = (conv['number'], chunk_offset, chunk_size)
+            # a short segment may be written after the end of a range
+            if (conv['end'] is not None) and (chunk_index >= conv['end']):
+                self.stop_conv(conv)
+
+                return False
+
+            self.cache.put(self.get_chunk_key(chunk_index), chunk_filepath)
+            self.chunks.add(chunk_index)
             self.remove_clients_chunk(chunk_index)
 
-            if chunk_index in self.chunk_requests:
-                self.chunk_requests[chunk_index].set()
+            future = self.chunk_requests.pop(chunk_index, None)
+
+            if future is not None and not future.done():
+                future.set_result(None)
 
         conv['time'] += len(chunks)
+        self.notify_update()
 
         return True
 
+    # adds a part of the chunk being converted, and adds the chunk once its last part is complete
+    async def conv_add_part(self, conv, part_filepath):
+        chunk_index = conv['time']
+
+        if (chunk_index in self.chunks) or ((conv['end'] is not None) and (chunk_index >= conv['end'])):
+            LOG.info("[#%d] Dropping conversion after encountering a converted chunk", conv['number'])
+            self.stop_conv(conv)
+
+            return False
+
+        conv['parts'].append(part_filepath)
+
+        # parts of a chunk converted by several conversions are listed from the first one only
+        self.parts.setdefault(chunk_index, conv['parts'])
+        self.notify_update()
+
+        if len(conv['parts']) < len(self.get_part_times(chunk_index)) - 1:
+            return True
+
+        LOG.info("[#%d] Adding chunk %d from %d parts", conv['number'], chunk_index, len(conv['parts']))
+
+        chunk_filepath = os.path.join(os.path.dirname(part_filepath), f"chunk-{chunk_index}.ts")
+        await asyncio.get_running_loop().run_in_executor(None, concatenate_files, conv['parts'], chunk_filepath)
+
+        conv['parts'] = list()
+
+        # stopped while the parts were being concatenated
+        if conv['stopped']:
+            return False
+
+        # parts of the previous chunk are not listed in playlists anymore
+        #   unless they belong to another conversion, such as a resumed range conversion which is still writing them
+        previous_part_filepaths = self.parts.get(chunk_index - 1, list())
+
+        if previous_part_filepaths and (os.path.dirname(previous_part_filepaths[0]) == os.path.dirname(part_filepath)):
+            del self.parts[chunk_index - 1]
+
+            for previous_part_filepath in previous_part_filepaths:
+                try:
+                    os.remove(previous_part_filepath)
+                except OSError:
+                    pass
+
+        return self.conv_add_chunks(conv, [chunk_filepath])
+
+    # returns the start time of each part of a chunk followed by the end time of the chunk
+    def get_part_times(self, chunk_index):
+        start_time = self.chunk_times[chunk_index]
+        end_time = self.chunk_times[chunk_index + 1]
+        part_count = max(1, round((end_time - start_time) / self.options['part_duration']))
+
+        return [start_time + (end_time - start_time) * part_index / part_count for part_index in range(part_count)] + [end_time]
+
+    # wakes up the requests waiting for a part or a chunk
+    def notify_update(self):
+        if (self.update_future is not None) and not self.update_future.done():
+            self.update_future.set_result(None)
+
+        self.update_future = None
+
+    # waits for a part or a chunk to be added, raising asyncio.TimeoutError after 'timeout' seconds unless it is None
+    async def wait_update(self, timeout = None):
+        if self.update_future is None:
+            self.update_future = asyncio.get_running_loop().create_future()
+
+        # shielded as the future is shared by all waiting requests
+        await asyncio.wait_for(asyncio.shield(self.update_future), timeout)
+
+    # kills the process of a conversion, whose task then exits on its own
     def stop_conv(self, conv):
-        conv['process'].kill()
-        conv['process'].wait() # ?
-        self.conversions.remove(conv)
+        conv['stopped'] = True
 
-    def log_chunks(self):
-        out_str = ""
+        if conv['process'] is not None and conv['process'].returncode is None:
+            try:
+                conv['process'].kill()
+            except ProcessLookupError:
+                pass
+
+        if conv in self.conversions:
+            self.conversions.remove(conv)
 
-        for chunk in self.chunks:
-            out_str += "-" if chunk is None else "="
+    # pauses the process of a conversion, which keeps its position in the source and its output
+    def suspend_conv(self, conv):
+        conv['suspended'] = True
+        self.signal_conv(conv, signal.SIGSTOP)
 
-        return out_str
+    def resume_conv(self, conv):
+        conv['suspended'] = False
+        self.signal_conv(conv, signal.SIGCONT)
+
+    def signal_conv(self, conv, signum):
+        if conv['process'] is not None and conv['process'].returncode is None:
+            try:
+                conv['process'].send_signal(signum)
+            except ProcessLookupError:
+                pass
+
+    # logs the converted chunks as ranges, and as one character per chunk when debugging
+    def log_chunks(self, conv):
+        LOG.info("[#%d] Converted chunks: %s", conv['number'], ", ".join(f"{start}-{end - 1}" for start, end in self.chunks.ranges()) or "none")
+        LOG.debug("[#%d] %s", conv['number'], self.chunks.format())
 
     async def wait_chunk(self, client_id, chunk_index):
-        if self.chunks[chunk_index] is not None:
+        if chunk_index in self.chunks:
             return
 
         if not chunk_index in self.chunk_requests:
-            self.chunk_requests[chunk_index] = threading.Event()
+            self.chunk_requests[chunk_index] = asyncio.get_running_loop().create_future()
 
         LOG.info("[cl. %s] Waiting for chunk %d", client_id, chunk_index)
 
-        loop = asyncio.get_running_loop()
-        chunk_buffer = await loop.run_in_executor(None, lambda: self.chunk_requests[chunk_index].wait())
+        # shielded as the future is shared by all clients waiting for this chunk
+        await asyncio.shield(self.chunk_requests[chunk_index])
 
 
+    # returns the path of a chunk in the segment cache once it is converted, or None if the request was cancelled
     async def get_chunk(self, client_id, chunk_index):
-        self.add_client_chunk(client_id, chunk_index)
+        self.update_playhead(client_id, chunk_index)
 
-        try:
-            await self.wait_chunk(client_id, chunk_index)
-        except asyncio.CancelledError:
-            LOG.info("[cl. %s] Cancelling request of chunk %d", client_id, chunk_index)
-            self.remove_client_chunk(client_id, chunk_index)
-            return None
+        while True:
+            self.add_client_chunk(client_id, chunk_index)
 
-        chunk = self.chunks[chunk_index]
+            try:
+                await self.wait_chunk(client_id, chunk_index)
+            except asyncio.CancelledError:
+                LOG.info("[cl. %s] Cancelling request of chunk %d", client_id, chunk_index)
+                self.remove_client_chunk(client_id, chunk_index)
+                return None
 
-        if chunk is None:
-            return None
+            if not chunk_index in self.chunks:
+                return None
+
+            # marks the chunk as recently used
+            filepath = self.cache.get(self.get_chunk_key(chunk_index))
+
+            if (filepath is not None) and os.path.isfile(filepath):
+                return filepath
 
-        (file_index, chunk_offset, chunk_size) = chunk
-        filepath = self.out_files[file_index]
+            LOG.info("[cl. %s] Chunk %d was evicted from the cache, converting it again", client_id, chunk_index)
 
-        with open(filepath, 'rb') as file:
-            file.seek(chunk_offset)
-            return file.read(chunk_size)
+            self.chunks.discard(chunk_index)
+            self.chunk_requests.pop(chunk_index, None)
+
+    def get_target_duration(self):
+        return math.ceil(get_max_interval(self.chunk_times))
 
     def generate_playlist(self):
-        playlist = f"#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:{self.options['chunk_duration']}\n#EXT-X-MEDIA-SEQUENCE:0\n#EXT-X-PLAYLIST-TYPE:EVENT\n"
+        lines = [f"#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:{self.get_target_duration()}\n#EXT-X-MEDIA-SEQUENCE:0\n#EXT-X-PLAYLIST-TYPE:EVENT\n"]
 
-        for chunk_index, chunk in enumerate(self.chunks):
-            playlist += f"#EXTINF:{self.options['chunk_duration']},\nchunk/{chunk_index}.ts\n#EXT-X-DISCONTINUITY\n"
+        for chunk_index in range(len(self.chunks)):
+            chunk_duration = self.chunk_times[chunk_index + 1] - self.chunk_times[chunk_index]
+            lines.append(f"#EXTINF:{chunk_duration:.3f},\nchunk/{chunk_index}.ts\n#EXT-X-DISCONTINUITY\n")
 
-        playlist += "#EXT-X-ENDLIST\n"
+        lines.append("#EXT-X-ENDLIST\n")
 
-        return playlist
+        return "".join(lines)
 
-    def stop(self):
-        for conv in self.conversions:
+    def get_playlist(self):
+        if self.playlist is None:
+            self.playlist = create_playlist(self.generate_playlist())
+
+        return self.playlist
+
+    # returns the first chunk which is not converted from the position of a client, the chunk whose parts are listed in the client's low-latency playlist
+    def get_edge_chunk(self, client_id):
+        state = self.playheads.get(client_id)
+        edge_chunk_index = self.chunks.next_missing(state['last_chunk'] if state is not None else 0)
+
+        return edge_chunk_index if edge_chunk_index is not None else len(self.chunks)
+
+    def generate_ll_playlist(self, client_id):
+        """
+        Returns a low-latency playlist which lists complete chunks up to the
+        first missing chunk from the position of the client, followed by the
+        complete parts of that chunk and a preload hint for its next part.
+        Chunks before the position of the client can be missing, in which
+        case they are converted when requested, as with regular playlists.
+        """
+
+        edge_chunk_index = self.get_edge_chunk(client_id)
+
+        if self.part_target is None:
+            self.part_target = max(get_max_interval(self.get_part_times(chunk_index)) for chunk_index in range(len(self.chunks)))
+
+        part_target = self.part_target
+
+        lines = [
+            f"#EXTM3U\n#EXT-X-VERSION:9\n#EXT-X-TARGETDURATION:{self.get_target_duration()}\n#EXT-X-MEDIA-SEQUENCE:0\n#EXT-X-PLAYLIST-TYPE:EVENT\n",
+            f"#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,PART-HOLD-BACK={part_target * 3:.3f}\n#EXT-X-PART-INF:PART-TARGET={part_target:.3f}\n"
+        ]
+
+        for chunk_index in range(edge_chunk_index):
+            if chunk_index == edge_chunk_index - 1:
+                lines += self.generate_part_lines(chunk_index)
+
+            chunk_duration = self.chunk_times[chunk_index + 1] - self.chunk_times[chunk_index]
+            lines.append(f"#EXTINF:{chunk_duration:.3f},\nchunk/{chunk_index}.ts\n#EXT-X-DISCONTINUITY\n")
+
+        if edge_chunk_index < len(self.chunks):
+            lines += self.generate_part_lines(edge_chunk_index)
+            lines.append(f"#EXT-X-PRELOAD-HINT:TYPE=PART,URI=\"part/{edge_chunk_index}.{len(self.parts.get(edge_chunk_index, list()))}.ts\"\n")
+        else:
+            lines.append("#EXT-X-ENDLIST\n")
+
+        return "".join(lines)
+
+    def generate_part_lines(self, chunk_index):
+        part_times = self.get_part_times(chunk_index)
+
+        return [f"#EXT-X-PART:DURATION={part_times[part_index + 1] - part_times[part_index]:.3f},URI=\"part/{chunk_index}.{part_index}.ts\"{',INDEPENDENT=YES' if part_index == 0 else ''}\n" for part_index in range(len(self.parts.get(chunk_index, list())))]
+
+    # returns whether a chunk is converted, or if 'part_index' is not None, whether a part of it is available
+    def has_part(self, chunk_index, part_index = None):
+        return (chunk_index in self.chunks) or ((part_index is not None) and (part_index < len(self.parts.get(chunk_index, list()))))
+
+    # returns the low-latency playlist of a client once it contains a chunk or a part, or after 'timeout' seconds
+    async def get_ll_playlist(self, client_id, chunk_index = None, part_index = None, *, timeout):
+        # the client waits for the edge chunk, which is converted as if it had requested it
+        self.add_client_chunk(client_id, min(self.get_edge_chunk(client_id), len(self.chunks) - 1))
+
+        if chunk_index is not None:
+            end_time = time.time() + timeout
+
+            while not (self.has_part(chunk_index, part_index) or self.stopped):
+                try:
+                    await self.wait_update(end_time - time.time())
+                except asyncio.TimeoutError:
+                    break
+
+        return self.generate_ll_playlist(client_id)
+
+    # returns the path of a part once it is converted, or None if its chunk was converted without it or after 'timeout' seconds
+    async def get_part(self, client_id, chunk_index, part_index, *, timeout):
+        self.update_playhead(client_id, chunk_index)
+        self.add_client_chunk(client_id, chunk_index)
+
+        end_time = time.time() + timeout
+
+        while not self.stopped:
+            part_filepaths = self.parts.get(chunk_index, list())
+
+            if part_index < len(part_filepaths):
+                return part_filepaths[part_index]
+
+            if (chunk_index in self.chunks) or (part_index >= len(self.get_part_times(chunk_index)) - 1):
+                return None
+
+            try:
+                await self.wait_update(end_time - time.time())
+            except asyncio.TimeoutError:
+                return None
+
+        return None
+
+    # stops all conversions and releases the requests waiting for chunks or parts
+    async def stop(self):
+        self.stopped = True
+        self.scheduler.update(self, list())
+
+        tasks = [conv['task'] for conv in self.conversions]
+
+        for conv in list(self.conversions):
             self.stop_conv(conv)
-            conv['thread'].join()
 
+        for future in self.chunk_requests.values():
+            if not future.done():
+                future.set_result(None)
+
+        self.chunk_requests.clear()
+        self.notify_update()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+
+class TranscoderScheduler:
+    """
+    Process-wide scheduler which starts or resumes the conversions requested
+    by all controllers while keeping at most 'limit' of them running,
+    suspended conversions not being counted. Requests with the lowest
+    priority value, i.e. the most urgent, are started first, and may preempt
+    a running conversion whose priority value is higher by at least
+    'preempt_margin', which is then suspended. Requests for range
+    conversions are only started when there is idle capacity. Like
+    controllers, it is only used from the event loop.
+    """
+
+    def __init__(self, *, limit, preempt_margin = 6):
+        self.limit = limit
+        self.preempt_margin = preempt_margin
+
+        self._controllers = set()
+
+        # controller -> list of (chunk index, priority, end chunk index)
+        self._requests = dict()
+
+    # 'requests' is a list of (chunk index, priority, end chunk index), the end chunk index being None except for range conversions
+    def update(self, controller, requests):
+        if requests:
+            self._controllers.add(controller)
+            self._requests[controller] = requests
+        else:
+            self._requests.pop(controller, None)
+
+        self.schedule()
+
+    # called when a conversion ends
+    def release(self):
+        self.schedule()
+
+    # returns the number of conversions which can be started without preempting another one
+    def get_idle_count(self):
+        return max(0, self.limit - len(self.get_running_convs()))
+
+    def get_running_convs(self):
+        return [(controller, conv) for controller in self._controllers for conv in controller.conversions if not conv['suspended']]
+
+    def schedule(self):
+        candidates = sorted(((controller, request) for controller, requests in self._requests.items() for request in requests), key=lambda candidate: (candidate[1][1], candidate[1][0], id(candidate[0])))
+
+        preempted_controllers = set()
+
+        for controller, request in candidates:
+            (chunk_index, priority, end_chunk_index) = request
+
+            # already handled by a nested call
+            if not request in self._requests.get(controller, list()):
+                continue
+
+            running_convs = self.get_running_convs()
+
+            if len(running_convs) >= self.limit:
+                # range conversions only use idle capacity
+                if end_chunk_index is not None:
+                    continue
+
+                (victim_controller, victim_conv) = max(running_convs, key=lambda item: item[1]['priority'])
+
+                if victim_conv['priority'] - priority < self.preempt_margin:
+                    break
+
+                LOG.info("[#%d] Preempting conversion with priority %.1f for chunk %d with priority %.1f", victim_conv['number'], victim_conv['priority'], chunk_index, priority)
+                victim_controller.suspend_conv(victim_conv)
+                preempted_controllers.add(victim_controller)
+
+            self._requests[controller].remove(request)
+
+            if not self._requests[controller]:
+                del self._requests[controller]
+
+            if not chunk_index in controller.chunks:
+                controller.start_conversion(chunk_index, priority, end_chunk_index)
+
+        # clients of preempted conversions request them again, to be resumed once there is room
+        for controller in preempted_controllers:
+            controller.manage_conversions()
+
+        self._controllers = {controller for controller in self._controllers if controller.conversions or controller in self._requests}
 
 
 class MediaServer:
-    def __init__(self):
+    def __init__(self, *, cache, scheduler, part_duration = 0, token_ttl = 6 * 3600, idle_timeout = 1800, sweep_interval = 60):
+        self.cache = cache
+        self.part_duration = part_duration
+        self.scheduler = scheduler
+
+        # delay after which a token which is not used anymore expires (in seconds)
+        self.token_ttl = token_ttl
+
+        # delay after which a controller which is not used anymore is stopped and removed (in seconds)
+        self.idle_timeout = idle_timeout
+
+        # delay between two removals of expired tokens and idle controllers (in seconds)
+        self.sweep_interval = sweep_interval
+
+        self._sweeper = None
         self.controllers = dict()
         self.clients = dict()
         self.files = dict()
 
+        # item id -> { 'audio_channel', 'controllers', 'duration', 'file_id', 'filepath', 'll_playlist', 'options', 'playlist', 'renditions' }
+        #   an item is a file with an audio stream, with one controller per rendition created on its first request
+        self.items = dict()
+
     def create_app(self):
-        async def route_playlist(request):
+        def get_client_controller(request):
             token = request.match_info.get('token')
             client = self.clients.get(token)
 
             if client is None:
                 raise web.HTTPBadRequest()
 
-            controller = self.controllers[client['controller_id']]
-            playlist = controller.generate_playlist()
+            client['last_access_time'] = time.time()
+            controller = self.get_controller(client['item_id'], request.match_info.get('rendition'))
 
-            return web.Response(text=playlist, headers={
-                "Access-Control-Allow-Origin": "*",
-                "Content-Type": "vnd.apple.mpegURL"
-            })
+            if controller is None:
+                raise web.HTTPNotFound()
 
-        async def route_chunk(request):
-            token = request.match_info.get('token')
-            client = self.clients.get(token)
+            return token, controller
+
+        def get_client_item(request):
+            client = self.clients.get(request.match_info.get('token'))
 
             if client is None:
                 raise web.HTTPBadRequest()
 
-            controller = self.controllers[client['controller_id']]
+            client['last_access_time'] = time.time()
+            return self.items[client['item_id']]
+
+        def get_query_int(request, name):
+            value = request.query.get(name)
+
+            try:
+                return int(value) if value is not None else None
+            except ValueError:
+                raise web.HTTPBadRequest()
+
+        async def route_master_playlist(request):
+            item = get_client_item(request)
+
+            if item['playlist'] is None:
+                item['playlist'] = create_playlist(generate_master_playlist(item['renditions']))
+
+            return create_playlist_response(request, item['playlist'])
+
+        async def route_playlist(request):
+            (token, controller) = get_client_controller(request)
+            return create_playlist_response(request, controller.get_playlist())
+
+        async def route_master_ll_playlist(request):
+            if self.part_duration <= 0:
+                raise web.HTTPNotFound()
+
+            item = get_client_item(request)
+
+            if item['ll_playlist'] is None:
+                item['ll_playlist'] = create_playlist(generate_master_playlist(item['renditions'], "ll.m3u8"))
+
+            return create_playlist_response(request, item['ll_playlist'])
+
+        # blocks until the playlist contains the chunk '_HLS_msn', or its part '_HLS_part', if they are given
+        async def route_ll_playlist(request):
+            if self.part_duration <= 0:
+                raise web.HTTPNotFound()
+
+            (token, controller) = get_client_controller(request)
+
+            chunk_index = get_query_int(request, '_HLS_msn')
+            part_index = get_query_int(request, '_HLS_part')
+
+            if (part_index is not None) and (chunk_index is None):
+                raise web.HTTPBadRequest()
+
+            if (chunk_index is not None) and (chunk_index > controller.get_edge_chunk(token) + 1):
+                raise web.HTTPBadRequest()
+
+            playlist = await controller.get_ll_playlist(token, chunk_index, part_index, timeout=(controller.get_target_duration() * 3))
+
+            return create_playlist_response(request, create_playlist(playlist))
 
+        async def route_part(request):
+            (token, controller) = get_client_controller(request)
             chunk_index = int(request.match_info.get('chunk_index'))
-            chunk_buffer = await controller.get_chunk(token, chunk_index)
+            part_index = int(request.match_info.get('part_index'))
+
+            if (self.part_duration <= 0) or not (0 <= chunk_index < len(controller.chunks)):
+                raise web.HTTPNotFound()
 
-            if chunk_buffer is None:
+            part_filepath = await controller.get_part(token, chunk_index, part_index, timeout=(controller.get_target_duration() * 3))
+
+            if part_filepath is None:
+                raise web.HTTPNotFound()
+
+            return web.FileResponse(part_filepath, headers={
+                "Access-Control-Allow-Origin": "*",
+                "Access-Control-Expose-Headers": "Content-Length, Content-Range",
+                "Cache-Control": "private, max-age=86400, immutable",
+                "Content-Type": "video/MP2T"
+            })
+
+        async def route_chunk(request):
+            (token, controller) = get_client_controller(request)
+            chunk_index = int(request.match_info.get('chunk_index'))
+
+            if not 0 <= chunk_index < len(controller.chunks):
+                raise web.HTTPNotFound()
+
+            chunk_filepath = await controller.get_chunk(token, chunk_index)
+
+            if chunk_filepath is None:
                 raise web.HTTPBadRequest()
 
-            return web.Response(body=chunk_buffer, headers={
+            # the content of a chunk never changes for a given controller, and thus for a given token
+            headers = {
                 "Access-Control-Allow-Origin": "*",
+                "Access-Control-Expose-Headers": "Content-Length, Content-Range",
+                "Cache-Control": "private, max-age=86400, immutable",
                 "Content-Type": "video/MP2T"
+            }
+
+            # shared by all clients of the controller, as the key does not depend on the token
+            #   loaded on its first access when several clients are watching, as each of them only reads it once
+            chunk_buffer = await self.cache.read(controller.get_chunk_key(chunk_index), shared=(controller.get_active_client_count() > 1))
+
+            if chunk_buffer is not None:
+                return create_buffer_response(request, chunk_buffer, headers)
+
+            # sent with sendfile when possible, with support for Range requests
+            return web.FileResponse(chunk_filepath, headers=headers)
+
+        async def route_stats(request):
+            return web.json_response(self.get_stats(), headers={
+                "Access-Control-Allow-Origin": "*"
             })
 
 
         app = web.Application()
 
         app.add_routes([
-            web.get('/{token}/playlist.m3u8', route_playlist),
-            web.get('/{token}/chunk/{chunk_index}.ts', route_chunk)
+            web.get('/stats', route_stats),
+            web.get('/{token}/playlist.m3u8', route_master_playlist),
+            web.get('/{token}/{rendition}/playlist.m3u8', route_playlist),
+            web.get('/{token}/{rendition}/chunk/{chunk_index}.ts', route_chunk),
+            web.get('/{token}/ll.m3u8', route_master_ll_playlist),
+            web.get('/{token}/{rendition}/ll.m3u8', route_ll_playlist),
+            web.get(r'/{token}/{rendition}/part/{chunk_index:\d+}.{part_index:\d+}.ts', route_part)
         ])
 
         return app
 
-    def stop(self):
+    async def start(self):
+        self._sweeper = asyncio.ensure_future(self.run_sweeper())
+
+    async def stop(self):
         LOG.info("Stopping media server")
 
-        for controller in self.controllers.values():
-            controller.stop()
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+
+        for controller in list(self.controllers.values()):
+            await controller.stop()
+
+        self.cache.stop()
 
         LOG.info("Stopped media server")
 
+    async def run_sweeper(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+
+            try:
+                await self.sweep()
+            except Exception:
+                LOG.exception("Could not remove idle objects")
+
+    async def sweep(self):
+        """
+        Removes tokens which were not used for 'token_ttl' seconds, then
+        stops and removes controllers which were not used for 'idle_timeout'
+        seconds, releasing their conversions and chunk maps, and finally
+        removes items which have neither tokens nor controllers left.
+        Converted chunks stay in the segment cache.
+        """
+
+        current_time = time.time()
+
+        for token, client in list(self.clients.items()):
+            if current_time - client['last_access_time'] > self.token_ttl:
+                LOG.info("Removing expired token %s", token)
+                del self.clients[token]
+
+                for controller_id in self.items[client['item_id']]['controllers'].values():
+                    self.controllers[controller_id].remove_client(token)
+
+        for item_id, item in list(self.items.items()):
+            for rendition_name, controller_id in list(item['controllers'].items()):
+                controller = self.controllers[controller_id]
+
+                if current_time - controller.last_access_time > self.idle_timeout:
+                    LOG.info("Removing idle controller %s", controller_id)
+
+                    del item['controllers'][rendition_name]
+                    del self.controllers[controller_id]
 
-    def add_item(self, file_id, filepath, duration, audio_channel):
-        controller_id = "%x" % abs(hash((file_id, audio_channel)))
+                    await controller.stop()
+
+        item_ids = {client['item_id'] for client in self.clients.values()}
+
+        for item_id, item in list(self.items.items()):
+            if (not item_id in item_ids) and not item['controllers']:
+                self.remove_item(item_id)
+
+    def get_stats(self):
+        conversions = [conv for controller in self.controllers.values() for conv in controller.conversions]
+
+        return {
+            'clients': len(self.clients),
+            'controllers': len(self.controllers),
+            'conversions': len(conversions),
+            'items': len(self.items),
+            'memory_cache': self.cache.memory_cache.get_stats() if self.cache.memory_cache is not None else None,
+            'segment_cache': {
+                'count': len(self.cache.entries),
+                'size': self.cache.size
+            },
+            'suspended_conversions': len([conv for conv in conversions if conv['suspended']]),
+            'waiting_requests': sum(len(controller.chunk_requests) for controller in self.controllers.values())
+        }
+
+
+    def add_item(self, file_id, filepath, duration, audio_channel, *, bit_rate = None, video_height = None, video_width = None, **kwargs):
+        item_id = "%x" % abs(hash((file_id, audio_channel)))
         token = "%x" % random.randrange(16 ** 16)
 
-        LOG.info("Requesting conversion setup for file %s and audio channel %d, controller %s, token %s", file_id, audio_channel, controller_id, token)
+        LOG.info("Requesting conversion setup for file %s and audio channel %d, item %s, token %s", file_id, audio_channel, item_id, token)
 
         self.clients[token] = {
-            'controller_id': controller_id
+            'item_id': item_id,
+            'last_access_time': time.time()
         }
 
-        if not controller_id in self.controllers:
-            self.controllers[controller_id] = FileConversionController(filepath, duration, audio_channel)
+        if not item_id in self.items:
+            self.items[item_id] = {
+                'audio_channel': audio_channel,
+
+                # rendition name -> controller id
+                'controllers': dict(),
+
+                'duration': duration,
+                'file_id': file_id,
+                'filepath': filepath,
+                'options': kwargs,
+
+                # encoded master playlists, built on their first request
+                'll_playlist': None,
+                'playlist': None,
+
+                'renditions': get_renditions(bit_rate, video_width, video_height)
+            }
+
             if not file_id in self.files:
                 self.files[file_id] = list()
 
-            self.files[file_id].append(controller_id)
+            self.files[file_id].append(item_id)
 
         return f"{token}/playlist.m3u8"
 
-    def discard_file(self, file_id):
-        if file_id in self.files:
-            for controller_id in self.files[file_id]:
-                # self.controllers[controller_id].stop()
-                pass
+    # returns the controller of a rendition of an item, creating it if needed, or None if the item has no such rendition
+    def get_controller(self, item_id, rendition_name):
+        item = self.items[item_id]
+        rendition = next((rendition for rendition in item['renditions'] if rendition['name'] == rendition_name), None)
+
+        if rendition is None:
+            return None
+
+        controller_id = item['controllers'].get(rendition_name)
+
+        if controller_id is None:
+            controller_id = "%x" % abs(hash((item['file_id'], item['audio_channel'], rendition_name)))
+            LOG.info("Creating controller %s for rendition %s of item %s", controller_id, rendition_name, item_id)
+
+            self.controllers[controller_id] = FileConversionController(item['filepath'], item['duration'], item['audio_channel'], file_id=item['file_id'], cache=self.cache, scheduler=self.scheduler, rendition=(rendition if rendition['scaled'] else None), part_duration=self.part_duration, **item['options'])
+            item['controllers'][rendition_name] = controller_id
+
+        controller = self.controllers[controller_id]
+        controller.last_access_time = time.time()
+
+        return controller
+
+    def remove_item(self, item_id):
+        item = self.items.pop(item_id)
+        item_ids = self.files.get(item['file_id'], list())
+
+        if item_id in item_ids:
+            item_ids.remove(item_id)
+
+        if not item_ids:
+            self.files.pop(item['file_id'], None)
+
+    def move_file(self, file_id, filepath):
+        for item_id in self.files.get(file_id, list()):
+            item = self.items[item_id]
+            item['filepath'] = filepath
+
+            for controller_id in item['controllers'].values():
+                self.controllers[controller_id].filepath = filepath
+
+    # removes the tokens, items and controllers of a file which was removed, stopping its conversions
+    async def discard_file(self, file_id):
+        item_ids = list(self.files.get(file_id, list()))
+
+        for token, client in list(self.clients.items()):
+            if client['item_id'] in item_ids:
+                del self.clients[token]
+
+        for item_id in item_ids:
+            controller_ids = list(self.items[item_id]['controllers'].values())
+            self.remove_item(item_id)
+
+            for controller_id in controller_ids:
+                await self.controllers.pop(controller_id).stop()
+
+
+
+
+def get_chunk_times(duration, chunk_duration, keyframe_times = None):
+    """
+    Returns the start time of each chunk followed by the duration of the
+    video. Without keyframes, chunks last exactly 'chunk_duration'.
+    Otherwise each chunk starts on the first keyframe after the end of the
+    'chunk_duration' slot in which the previous chunk starts, so that
+    chunks last 'chunk_duration' on average and can be cut or copied
+    without decoding frames before their start.
+    """
+
+    if not keyframe_times:
+        return [chunk_index * chunk_duration for chunk_index in range(math.ceil(duration / chunk_duration))] + [duration]
+
+    chunk_times = [0]
+
+    for keyframe_time in keyframe_times:
+        # the last chunk is merged with the previous one rather than being very short
+        if keyframe_time > duration - chunk_duration * 0.5:
+            break
+
+        if keyframe_time >= (math.floor(chunk_times[-1] / chunk_duration) + 1) * chunk_duration:
+            chunk_times.append(keyframe_time)
+
+    return chunk_times + [duration]
+
+# returns the longest interval between consecutive times
+def get_max_interval(times):
+    return max((b - a for a, b in zip(times, times[1:])), default=0)
+
+
+# returns the renditions offered for a video, from the highest to the lowest resolution
+#   the source is always offered, and only renditions with a lower resolution are added
+def get_renditions(bit_rate, video_width, video_height):
+    renditions = [{
+        'bandwidth': bit_rate or 8000000,
+        'height': video_height,
+        'name': "source",
+        'scaled': False,
+        'video_bitrate': None,
+        'width': video_width
+    }]
+
+    if not (video_width and video_height):
+        return renditions
+
+    for rendition in RENDITIONS:
+        if rendition['height'] < video_height:
+            renditions.append({
+                **rendition,
+                'bandwidth': rendition['video_bitrate'] + AUDIO_BITRATE,
+                'scaled': True,
+
+                # rounded to an even number as required by libx264, like with scale=-2
+                'width': round(video_width * rendition['height'] / video_height / 2) * 2
+            })
+
+    return renditions
+
+def generate_master_playlist(renditions, playlist_name = "playlist.m3u8"):
+    playlist = "#EXTM3U\n#EXT-X-VERSION:3\n"
+
+    for rendition in renditions:
+        resolution = f",RESOLUTION={rendition['width']}x{rendition['height']}" if rendition['width'] and rendition['height'] else ""
+        playlist += f"#EXT-X-STREAM-INF:BANDWIDTH={rendition['bandwidth']}{resolution}\n{rendition['name']}/{playlist_name}\n"
+
+    return playlist
+
+
+# writes the content of several files to a single file
+#   MPEG-TS files can be joined this way, as they are sequences of independent packets
+def concatenate_files(filepaths, out_filepath):
+    with open(out_filepath, 'wb') as out_file:
+        for filepath in filepaths:
+            with open(filepath, 'rb') as file:
+                shutil.copyfileobj(file, out_file)
+
+
+# returns a playlist encoded once, with the validators used for conditional requests
+def create_playlist(text):
+    body = text.encode("utf-8")
+
+    return {
+        'body': body,
+        'etag': '"%s"' % hashlib.sha1(body).hexdigest(),
+        'last_modified': time.time()
+    }
+
+# returns a response with a playlist, or a 304 response if the client already has it
+def create_playlist_response(request, playlist):
+    headers = {
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Expose-Headers": "ETag",
+        "Cache-Control": "no-cache",
+        "Content-Type": "vnd.apple.mpegURL",
+        "ETag": playlist['etag']
+    }
+
+    if_none_match = request.headers.get("If-None-Match")
+
+    if if_none_match is not None:
+        etags = [etag.strip() for etag in if_none_match.split(",")]
+        not_modified = ("*" in etags) or any((etag[2:] if etag.startswith("W/") else etag) == playlist['etag'] for etag in etags)
+    else:
+        if_modified_since = request.if_modified_since
+        not_modified = (if_modified_since is not None) and (if_modified_since.timestamp() >= math.floor(playlist['last_modified']))
+
+    response = web.Response(status=(304 if not_modified else 200), body=(None if not_modified else playlist['body']), headers=headers)
+    response.last_modified = playlist['last_modified']
+
+    return response
+
+
+# returns a response with the content of a buffer, or with the part of it selected by the Range header of the request
+def create_buffer_response(request, buffer, headers):
+    headers = { **headers, "Accept-Ranges": "bytes" }
+
+    if not "Range" in request.headers:
+        return web.Response(body=buffer, headers=headers)
+
+    try:
+        http_range = request.http_range
+    except ValueError:
+        raise web.HTTPRequestRangeNotSatisfiable(headers={ "Content-Range": f"bytes */{len(buffer)}" })
+
+    (start, stop, _) = http_range.indices(len(buffer))
 
-            del self.files[file_id]
+    if start >= stop:
+        raise web.HTTPRequestRangeNotSatisfiable(headers={ "Content-Range": f"bytes */{len(buffer)}" })
 
+    return web.Response(status=206, body=memoryview(buffer)[start:stop], headers={
+        **headers,
+        "Content-Range": f"bytes {start}-{stop - 1}/{len(buffer)}"
+    })
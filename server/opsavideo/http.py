@@ -1,8 +1,8 @@
 from aiohttp import WSCloseCode, web
+import aiohttp
 import asyncio
 import os
 import logging
-import urllib
 import weakref
 
 from .rpc import Server
@@ -74,6 +74,51 @@ class HTTPServer:
         LOG.info("Stopped HTTP server")
 
 
-def request(url):
-    return urllib.request.urlopen(url).read().decode("utf-8")
-
+class Fetcher:
+    """
+    Fetches URLs through a shared pool of keep-alive connections, with at most
+    'concurrency' requests in flight. Failed requests are retried up to
+    'retries' times, waiting 'backoff' seconds before the first retry and
+    twice as long before each following one.
+    """
+
+    def __init__(self, *, concurrency = 4, retries = 3, backoff = 1, timeout = 30):
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self._semaphore = None
+        self._session = None
+
+    async def request(self, url):
+        if self._session is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+
+        async with self._semaphore:
+            for attempt in range(self.retries + 1):
+                try:
+                    async with self._session.get(url) as response:
+                        response.raise_for_status()
+                        return await response.text()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                    # client errors other than 'Too Many Requests' will not go away by retrying
+                    if isinstance(err, aiohttp.ClientResponseError) and 400 <= err.status < 500 and err.status != 429:
+                        raise
+
+                    if attempt >= self.retries:
+                        raise
+
+                    delay = self.backoff * 2 ** attempt
+                    LOG.info("Request to '%s' failed (%s), retrying in %.1f s", url, err, delay)
+
+                    await asyncio.sleep(delay)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
@@ -1,76 +1,93 @@
+import asyncio
 import json
 import logging
 import lxml.html
 import os
 import time
-import urllib
+import urllib.parse
 
 from . import iso639
-from .http import request
+from .store import MetadataStore
 
 
 LOG = logging.getLogger("opsavideo.imdb")
 class IMDBDatabase:
-    def __init__(self, dir_path, version):
+    def __init__(self, dir_path, version, *, fetcher, imdb_url = "https://www.imdb.com", suggests_url = "http://sg.media-imdb.com"):
         self.cache_path = dir_path and os.path.join(dir_path, "imdb_cache.json")
-        self.medias = dict()
-        self.queries = dict()
+        self.fetcher = fetcher
+        self.imdb_url = imdb_url
+        self.suggests_url = suggests_url
         self.version = version
 
+        self.store = MetadataStore(os.path.join(dir_path, "imdb_cache.sqlite") if dir_path else ":memory:", version, tables=["medias", "queries"])
+
+        # requests in progress, shared by concurrent callers
+        self._pending = dict()
+
     def load_cache(self):
-        try:
-            if self.cache_path is None:
-                raise Exception("No cache path")
+        self.import_json_cache()
 
+        count = self.store.evict_expired()
+        LOG.info("Loaded cache with %d medias and %d queries, evicted %d expired entries", self.store.count("medias"), self.store.count("queries"), count)
+
+    # imports the cache written by previous versions, then deletes it
+    def import_json_cache(self):
+        if (self.cache_path is None) or not os.path.isfile(self.cache_path):
+            return
+
+        try:
             with open(self.cache_path, 'r') as file:
                 data = json.load(file)
 
-                if data.get('version') != self.version:
-                    raise Exception("Upgrade required")
+            for id, media in data['data']['medias'].items():
+                self.store.set("medias", id, media, expiration_time=media['expiration_time'])
 
-                self.medias = data['data']['medias']
-                self.queries = data['data']['queries']
-                LOG.info("Loaded cache")
+            for query, result in data['data']['queries'].items():
+                self.store.set("queries", query, result, expiration_time=result['expiration_time'])
 
-                return True
+            self.store.save()
+            os.remove(self.cache_path)
 
+            LOG.info("Imported JSON cache")
         except Exception as err:
-            LOG.info("Cound not load cache: %s", err)
-            return False
+            LOG.info("Cound not import JSON cache: %s", err)
 
     def save_cache(self):
-        if self.cache_path is None:
-            return
+        self.store.save()
 
-        with open(self.cache_path, 'w') as file:
-            json.dump({
-                'data': {
-                    'medias': self.medias,
-                    'queries': self.queries
-                },
-                'version': self.version
-            }, file)
+    async def close(self):
+        await self.fetcher.close()
+        self.store.close()
 
-    def query(self, query, *, year = None):
-        result = self.query_title(query)
+    async def request(self, url):
+        if not url in self._pending:
+            self._pending[url] = asyncio.ensure_future(self.fetcher.request(url))
+            self._pending[url].add_done_callback(lambda future: self._pending.pop(url, None))
 
-        for item in result['results']:
-            if (year is not None) and (item['year'] is not None) and (abs(year - item['year']) > 1):
-                continue
+        return await asyncio.shield(self._pending[url])
 
-            return item['id']
+    async def query(self, query, *, year = None):
+        result = await self.query_title(query)
+        return select_result(result, year)
 
-        return None
+    # same as query() but only uses the cache, returns False on a cache miss
+    def lookup(self, query, *, year = None):
+        cached_result = self.store.get("queries", query)
 
-    def query_title(self, query):
+        if cached_result is None or cached_result['expiration_time'] <= time.time():
+            return False
+
+        return select_result(cached_result, year)
+
+    async def query_title(self, query):
         LOG.info("Querying media '%s'", query)
 
-        cached_result = self.queries.get(query)
+        cached_result = self.store.get("queries", query)
         if cached_result is not None and cached_result['expiration_time'] > time.time():
             return cached_result
 
-        def run_query():
-            raw_data = request(f"http://sg.media-imdb.com/suggests/{urllib.parse.quote(query[0].lower())}/{urllib.parse.quote(query)}.json")
+        async def run_query():
+            raw_data = await self.request(f"{self.suggests_url}/suggests/{urllib.parse.quote(query[0].lower())}/{urllib.parse.quote(query)}.json")
             data = json.loads(raw_data[raw_data.index('(') + 1:-1])
 
             results = list()
@@ -88,19 +105,23 @@ class IMDBDatabase:
                 'expiration_time': int(time.time()) + 600000
             }
 
-        result = run_query()
-        self.queries[query] = result
+        result = await run_query()
+        self.store.set("queries", query, result, expiration_time=result['expiration_time'])
         return result
 
-    def request_media(self, id):
+    # returns the cached media, even if expired, or None
+    def get_media(self, id):
+        return self.store.get("medias", id)
+
+    async def request_media(self, id):
         LOG.info("Requesting media '%s'", id)
 
-        cached_result = self.medias.get(id)
+        cached_result = self.store.get("medias", id)
         if cached_result is not None and cached_result['expiration_time'] > time.time():
             return cached_result
 
-        def run_request():
-            tree = lxml.html.fromstring(request(f"https://www.imdb.com/title/{id}/"))
+        async def run_request():
+            tree = lxml.html.fromstring(await self.request(f"{self.imdb_url}/title/{id}/"))
 
             description = run_chain(get_first(tree.find_class("summary_text")), get_text_content)
             duration = run_chain(get_first(tree.xpath("//*[@id='titleDetails']//h4[text()='Runtime:']/../time")), lambda element: int(get_text_content(element)[0:-4]) * 60)
@@ -112,7 +133,7 @@ class IMDBDatabase:
             is_series = len(tree.find_class("np_episode_guide")) > 0
 
             try:
-                wallpaper_tree = lxml.html.fromstring(request(f"https://www.imdb.com/title/{id}/mediaindex?refine=still_frame"))
+                wallpaper_tree = lxml.html.fromstring(await self.request(f"{self.imdb_url}/title/{id}/mediaindex?refine=still_frame"))
                 wallpaper_url = run_chain(get_first(wallpaper_tree.xpath("//img[@width='100']")), lambda element: element.get("src"), transform_img_url)
             except Exception:
                 wallpaper_url = None
@@ -132,22 +153,22 @@ class IMDBDatabase:
                 'expiration_time': int(time.time()) + 600000
             }
 
-        result = run_request()
-        self.medias[id] = result
+        result = await run_request()
+        self.store.set("medias", id, result, expiration_time=result['expiration_time'])
         return result
 
     # 'season_number' is a string
-    def request_media_season(self, id, season_number):
-        media = self.medias[id]
+    async def request_media_season(self, id, season_number):
+        media = self.store.get("medias", id)
 
-        if media['seasons'] is None:
+        if (media is None) or (media['seasons'] is None):
             return False
 
         if season_number in media['seasons']:
             return True
 
         try:
-            tree = lxml.html.fromstring(request(f"https://www.imdb.com/title/{id}/episodes?season={season_number}"))
+            tree = lxml.html.fromstring(await self.request(f"{self.imdb_url}/title/{id}/episodes?season={season_number}"))
         except Exception:
             return False
 
@@ -165,9 +186,20 @@ class IMDBDatabase:
             }
 
         media['seasons'][season_number] = episodes
+        self.store.set("medias", id, media, expiration_time=media['expiration_time'])
+
         return True
 
 
+def select_result(result, year):
+    for item in result['results']:
+        if (year is not None) and (item['year'] is not None) and (abs(year - item['year']) > 1):
+            continue
+
+        return item['id']
+
+    return None
+
 def transform_img_url(url):
     return url[0:url.find("._V1_")] + "._V1_.jpg"
 
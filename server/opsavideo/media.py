@@ -1,42 +1,92 @@
 import PTN
 import asyncio
+import concurrent.futures
 import fnmatch
-import glob
 import hashlib
 import json
 import logging
 import os
 import subprocess
 import threading
+import time
 import watchdog.events
 import watchdog.observers
 
 from . import iso639
+from .batch import Batcher
+from .http import Fetcher
 from .imdb import IMDBDatabase
+from .pathtree import PathTree
+from .probe import ProbeCache
 
 
 LOG = logging.getLogger('opsavideo.media')
 class MediaManager:
-    def __init__(self, path, noticeboard, loop, server, *, state_dir):
+    def __init__(self, path, noticeboard, loop, server, *, state_dir, probe_workers = None, progress_noticeboard = None):
         self.obsever = None
         self.noticeboard = noticeboard
         self.loop = loop
         self.path = path
         self.server = server
 
-        self.imdb = IMDBDatabase(state_dir, version="0")
+        self.imdb = IMDBDatabase(state_dir, version="0", fetcher=Fetcher(concurrency=4, retries=3, backoff=1))
+        self.probe_cache = ProbeCache(state_dir, version="4")
 
         self.files = dict()
         self.medias = dict()
 
-        self.watcher = Watcher(self, origin=os.path.abspath(path), patterns=["*.avi", "*.mkv", "*.mp4"])
+        # path -> id of each file
+        self.paths = dict()
+
+        # guards 'files', 'medias' and 'paths', which are modified by the discovery and watcher threads and read when publishing
+        self.lock = threading.RLock()
+
+        # last published version of each media
+        self.out_medias = dict()
+
+        # number of ffprobe processes run concurrently during discovery
+        #   None: one per core
+        self.probe_workers = probe_workers or os.cpu_count() or 1
+
+        # builds keyframe indices in the background, one file at a time as each build reads a whole file
+        self.index_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        # fingerprint -> future of each keyframe index which is being built or could not be built
+        self.indexing = dict()
+
+        # (probed files, total files) of the current discovery, also published on 'progress_noticeboard' if there is one
+        self.discovery_progress = (0, 0)
+        self.progress_noticeboard = progress_noticeboard
+
+        self.options = {
+            # maximum delay between a change and its publication (in seconds)
+            'publish_delay': 0.5,
+
+            # maximum number of changed medias before they are published
+            'publish_size': 200,
+
+            # maximum delay between a change and the caches being saved (in seconds)
+            'save_delay': 10,
+
+            # maximum number of changed files before the caches are saved
+            'save_size': 1000
+        }
+
+        self.publisher = Batcher(self.publish, delay=self.options['publish_delay'], size=self.options['publish_size'])
+        self.cache_writer = Batcher(lambda items: self.save_caches(), delay=self.options['save_delay'], size=self.options['save_size'])
+
+        self.watcher = Watcher(self, origin=os.path.abspath(path), patterns=["*.avi", "*.mkv", "*.mp4"], state_dir=state_dir)
 
     def start(self):
         def handler():
             self.imdb.load_cache()
+            self.probe_cache.load_cache()
 
             LOG.info("Starting discovery")
             self.watcher.discover()
+            self.publisher.flush()
+            self.cache_writer.flush()
+
             LOG.info("Done discovering, starting watcher")
             self.watcher.start()
 
@@ -48,81 +98,272 @@ class MediaManager:
     def stop(self):
         self.watcher.stop()
 
-    def publish(self):
-        out_medias = dict()
+        with self.lock:
+            for future in self.indexing.values():
+                future.cancel()
 
-        for media_id, media in self.medias.items():
-            out_media = {
-                'id': media_id,
-                'files': dict(),
+        self.index_executor.shutdown(wait=False)
 
-                'description': None,
-                'poster_url': None,
-                'seasons': None,
-                'storyline': None,
-                'title': media.get('title'),
-                'year': media.get('year')
-            }
+        self.publisher.flush()
+        self.cache_writer.flush()
 
-            if 'imdb_id' in media:
-                imdb_media = self.imdb.request_media(media['imdb_id'])
-                out_media.update({
-                    'description': imdb_media['description'],
-                    'poster_url': imdb_media['poster_url'],
-                    'seasons': {season_num: {episode_num: {
-                        **episode, 'files': list()
-                    } for (episode_num, episode) in season.items()} for (season_num, season) in imdb_media['seasons'].items()} if imdb_media['seasons'] else None,
-                    'storyline': imdb_media['storyline'],
-                    'title': imdb_media['title'],
-                    'wallpaper_url': imdb_media['wallpaper_url']
-                })
+    def save_caches(self):
+        self.imdb.save_cache()
+        self.probe_cache.save_cache()
 
-            for file_id in media['files']:
-                file = self.files[file_id]
-                out_media['files'][file_id] = {
-                    'audio_streams': {str(stream['index']): stream['language'] for stream in file['audio_streams']},
-                    'quality': file['quality'],
-                    'resolution': file['resolution'],
-                    'size': file['size']
-                }
+    def publish(self, media_ids = None):
+        """
+        Publishes the medias in 'media_ids', or all medias if None, to the
+        noticeboard. Only the medias which changed since they were last
+        published are sent to subscribers.
+        """
+
+        with self.lock:
+            if media_ids is None:
+                media_ids = set(self.medias.keys()) | set(self.out_medias.keys())
 
-                season_num = file['season_number']
-                episode_num = file['episode_number']
+            changed = dict()
+            removed = list()
 
-                if season_num and episode_num:
-                    if not out_media['seasons']:
-                        out_media['seasons'] = dict()
+            for media_id in media_ids:
+                if media_id in self.medias:
+                    out_media = self.export_media(media_id)
 
-                    seasons = out_media['seasons']
-                    if not season_num in seasons:
-                        seasons[season_num] = dict()
+                    if self.out_medias.get(media_id) != out_media:
+                        self.out_medias[media_id] = out_media
+                        changed[media_id] = out_media
+                elif media_id in self.out_medias:
+                    del self.out_medias[media_id]
+                    removed.append(media_id)
 
-                    season = seasons[season_num]
-                    if not episode_num in season:
-                        season[episode_num] = {
-                            'description': None,
-                            'files': list(),
-                            'title': f"S{season_num}E{episode_num}",
-                            'thumbnail_url': None
-                        }
+        self.noticeboard.publish_changes_threadsafe(changed, removed, loop=self.loop)
 
-                    season[episode_num]['files'].append(file_id)
+    def export_media(self, media_id):
+        media = self.medias[media_id]
 
-            # out_medias.append(out_media)
-            out_medias[media_id] = out_media
+        out_media = {
+            'id': media_id,
+            'files': dict(),
 
-        self.noticeboard.publish_threadsafe(out_medias, loop=self.loop)
+            'description': None,
+            'poster_url': None,
+            'seasons': None,
+            'storyline': None,
+            'title': media.get('title'),
+            'year': media.get('year')
+        }
+
+        imdb_media = self.imdb.get_media(media['imdb_id']) if 'imdb_id' in media else None
+
+        if imdb_media is not None:
+            out_media.update({
+                'description': imdb_media['description'],
+                'poster_url': imdb_media['poster_url'],
+                'seasons': {season_num: {episode_num: {
+                    **episode, 'files': list()
+                } for (episode_num, episode) in season.items()} for (season_num, season) in imdb_media['seasons'].items()} if imdb_media['seasons'] else None,
+                'storyline': imdb_media['storyline'],
+                'title': imdb_media['title'],
+                'wallpaper_url': imdb_media['wallpaper_url']
+            })
+
+        for file_id in media['files']:
+            file = self.files[file_id]
+            out_media['files'][file_id] = {
+                'audio_streams': {str(stream['index']): stream['language'] for stream in file['audio_streams']},
+                'quality': file['quality'],
+                'resolution': file['resolution'],
+                'size': file['size']
+            }
+
+            season_num = file['season_number']
+            episode_num = file['episode_number']
+
+            if season_num and episode_num:
+                if not out_media['seasons']:
+                    out_media['seasons'] = dict()
+
+                seasons = out_media['seasons']
+                if not season_num in seasons:
+                    seasons[season_num] = dict()
+
+                season = seasons[season_num]
+                if not episode_num in season:
+                    season[episode_num] = {
+                        'description': None,
+                        'files': list(),
+                        'title': f"S{season_num}E{episode_num}",
+                        'thumbnail_url': None
+                    }
+
+                season[episode_num]['files'].append(file_id)
+
+        return out_media
+
+    def add_file(self, filepath, metadata = None):
+        """
+        Adds a file to the library. The file is published right away with the
+        information parsed from its name, and is moved to its IMDb media once
+        the metadata has been fetched, unless it is already cached.
+        """
+
+        if metadata is None:
+            metadata = self.get_cached_file_metadata(filepath)
 
-    def add_file(self, filepath):
         name = os.path.splitext(os.path.basename(filepath))[0]
         torrent = PTN.parse(name)
 
-        file_id = hash_str(filepath)
-        imdb_id = self.imdb.query(torrent['title'], year=torrent.get('year'))
+        file = {
+            **metadata,
+            'episode_number': str(torrent['episode']) if 'episode' in torrent else None,
+            'filepath': filepath,
+            'id': None,
+            'media_id': None,
+            'quality': torrent.get('quality'),
+            'resolution': torrent.get('resolution'),
+            'season_number': str(torrent['season']) if 'season' in torrent else None,
+            'size': os.path.getsize(filepath),
+            'title': torrent['title'],
+            'year': torrent.get('year')
+        }
+
+        imdb_id = self.lookup_file(file)
+
+        with self.lock:
+            file_id = metadata['fingerprint']
+
+            # another copy of the same file is already in the library
+            if (file_id in self.files) and (self.files[file_id]['filepath'] != filepath):
+                file_id = hash_str(file_id + filepath)
+
+            file['id'] = file_id
+            self.files[file_id] = file
+            self.paths[filepath] = file_id
+
+            media_id = self.attach_file(file_id, imdb_id)
+
+        LOG.info("Adding file '%s' (%s)", filepath, file_id)
+
+        self.cache_writer.add(filepath)
+        self.publisher.add(media_id)
+
+        if imdb_id is False:
+            asyncio.run_coroutine_threadsafe(self.resolve_file(file), self.loop)
+
+        self.queue_index(file_id)
+
+    # returns whether the content of a file changed since it was added, comparing its fingerprints
+    def is_file_changed(self, filepath):
+        with self.lock:
+            file_id = self.paths.get(filepath)
+
+            if file_id is None:
+                return True
+
+            fingerprint = self.files[file_id]['fingerprint']
+
+        try:
+            return self.probe_cache.get_fingerprint(filepath) != fingerprint
+        except OSError:
+            return True
+
+    def remove_file(self, filepath):
+        with self.lock:
+            file_id = self.paths.pop(filepath, None)
+
+            if file_id is None:
+                LOG.warn("Removing unknown file '%s'", filepath)
+                return
+
+            LOG.info("Removing file '%s' (%s)", filepath, file_id)
+
+            media_id = self.detach_file(file_id)
+            del self.files[file_id]
+
+        self.probe_cache.discard(filepath)
+
+        if self.server is not None:
+            asyncio.run_coroutine_threadsafe(self.server.discard_file(file_id), self.loop)
+
+        self.cache_writer.add(filepath)
+        self.publisher.add(media_id)
+
+    # updates the path of a file, keeping its id, probe results, metadata and conversions
+    def move_file(self, src_filepath, dest_filepath):
+        with self.lock:
+            file_id = self.paths.pop(src_filepath, None)
+
+            if file_id is None:
+                LOG.warn("Moving unknown file '%s'", src_filepath)
+                return
+
+            LOG.info("Moving file '%s' (%s) to '%s'", src_filepath, file_id, dest_filepath)
+
+            file = self.files[file_id]
+            file['filepath'] = dest_filepath
+            self.paths[dest_filepath] = file_id
+
+        self.probe_cache.move(src_filepath, dest_filepath)
+
+        if self.server is not None:
+            self.loop.call_soon_threadsafe(self.server.move_file, file_id, dest_filepath)
+
+        self.cache_writer.add(src_filepath, dest_filepath)
+        self.publisher.add(file['media_id'])
+
+    # returns the IMDb id of a file using only cached metadata, None if it has none and False if unknown
+    def lookup_file(self, file):
+        imdb_id = self.imdb.lookup(file['title'], year=file['year'])
+
+        if not imdb_id:
+            return imdb_id
+
+        imdb_media = self.imdb.get_media(imdb_id)
+
+        if imdb_media is None:
+            return False
+
+        if file['season_number'] and file['episode_number'] and (imdb_media['seasons'] is not None) and not (file['season_number'] in imdb_media['seasons']):
+            return False
+
+        return imdb_id
+
+    async def resolve_file(self, file):
+        try:
+            imdb_id = await self.imdb.query(file['title'], year=file['year'])
+
+            if imdb_id:
+                await self.imdb.request_media(imdb_id)
+
+                if file['season_number'] and file['episode_number']:
+                    await self.imdb.request_media_season(imdb_id, file['season_number'])
+        except Exception as err:
+            LOG.warn("Could not fetch metadata of file '%s': %s", file['filepath'], err)
+            return
+
+        self.cache_writer.add(file['filepath'])
+
+        if not imdb_id:
+            return
+
+        with self.lock:
+            file_id = file['id']
+
+            # the file was removed while fetching its metadata
+            if self.files.get(file_id) is not file:
+                return
+
+            old_media_id = self.detach_file(file_id)
+            media_id = self.attach_file(file_id, imdb_id)
+
+        self.publisher.add(old_media_id, media_id)
+
+    # adds a file to its media, creating the media if necessary, and returns the media's id
+    def attach_file(self, file_id, imdb_id):
+        file = self.files[file_id]
 
         if imdb_id:
             media_id = hash_str(imdb_id)
-            self.imdb.request_media(imdb_id) # prepare request
 
             if not media_id in self.medias:
                 self.medias[media_id] = {
@@ -131,44 +372,25 @@ class MediaManager:
                     'imdb_id': imdb_id
                 }
 
-            if ('season' in torrent) and ('episode' in torrent):
-                self.imdb.request_media_season(imdb_id, str(torrent['season']))
-
         else:
-            media_id = hash_str(torrent['title'])
+            media_id = hash_str(file['title'])
 
             if not media_id in self.medias:
                 self.medias[media_id] = {
                     'files': set(),
 
-                    'seasons': dict() if 'season' in torrent else None,
-                    'title': torrent['title'],
-                    'year': torrent.get('year')
+                    'seasons': dict() if file['season_number'] else None,
+                    'title': file['title'],
+                    'year': file['year']
                 }
 
-        self.files[file_id] = {
-            **self.get_file_metadata(filepath),
-            'episode_number': str(torrent['episode']) if 'episode' in torrent else None,
-            'filepath': filepath,
-            'media_id': media_id,
-            'quality': torrent.get('quality'),
-            'resolution': torrent.get('resolution'),
-            'season_number': str(torrent['season']) if 'season' in torrent else None,
-            'size': os.path.getsize(filepath)
-        }
-
-        media = self.medias[media_id]
-        media['files'].add(file_id)
+        file['media_id'] = media_id
+        self.medias[media_id]['files'].add(file_id)
 
-        LOG.info("Adding file '%s' (%s)", filepath, file_id)
-
-        self.imdb.save_cache()
-        self.publish()
-
-    def remove_file(self, filepath):
-        file_id = hash_str(filepath)
-        LOG.info("Removing file '%s' (%s)", filepath, file_id)
+        return media_id
 
+    # removes a file from its media, deleting the media if it has no file left, and returns the media's id
+    def detach_file(self, file_id):
         media_id = self.files[file_id]['media_id']
         media = self.medias[media_id]
 
@@ -177,13 +399,60 @@ class MediaManager:
         if not media['files']:
             del self.medias[media_id]
 
-        del self.files[file_id]
+        return media_id
+
 
-        self.publish()
+    def probe_files(self, filepaths):
+        """
+        Probes files using a pool of 'probe_workers' ffprobe processes and
+        yields (filepath, metadata) pairs in the order of 'filepaths'. The
+        metadata is None for files which could not be probed. Files which are
+        unchanged since they were last probed are read from the probe cache.
+        """
 
+        def probe(filepath):
+            try:
+                return self.get_cached_file_metadata(filepath)
+            except Exception as err:
+                LOG.warn("Could not probe file '%s': %s", filepath, err)
+                return None
+
+        total = len(filepaths)
+        self.discovery_progress = (0, total)
+        self.publish_discovery_progress()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.probe_workers) as executor:
+            for index, (filepath, metadata) in enumerate(zip(filepaths, executor.map(probe, filepaths)), start=1):
+                self.discovery_progress = (index, total)
+
+                if index % 100 == 0 or index == total:
+                    LOG.info("Probed %d/%d files", index, total)
+                    self.publish_discovery_progress()
+
+                yield filepath, metadata
+
+        self.cache_writer.add(*filepaths)
+
+    def publish_discovery_progress(self):
+        if self.progress_noticeboard is None:
+            return
+
+        (probed, total) = self.discovery_progress
+        self.progress_noticeboard.publish_threadsafe({ 'probed': probed, 'total': total }, loop=self.loop)
+
+    # returns the probe results of a file along with its fingerprint, which are reused when the file was moved
+    def get_cached_file_metadata(self, filepath):
+        fingerprint = self.probe_cache.get_fingerprint(filepath)
+        metadata = self.probe_cache.get(fingerprint)
+
+        if metadata is None:
+            metadata = self.get_file_metadata(filepath)
+            self.probe_cache.set(fingerprint, metadata)
+
+        return { **metadata, 'fingerprint': fingerprint }
 
     def get_file_metadata(self, filepath):
-        result = subprocess.run(["ffprobe", filepath, "-show_entries", "stream=codec_name,codec_type,index:stream_tags=language,title:format=duration", "-print_format", "json"], capture_output=True, text=True)
+        result = subprocess.run(["ffprobe", filepath, "-show_entries", "stream=avg_frame_rate,channels,codec_name,codec_type,height,index,width:stream_tags=language,title:format=bit_rate,duration", "-print_format", "json"], capture_output=True, text=True)
 
         if result.returncode != 0:
             raise Exception("ffprobe returned non-zero exit code")
@@ -191,7 +460,7 @@ class MediaManager:
         data = json.loads(result.stdout)
 
         audio_streams = list()
-        video_codec = None
+        video_stream = None
 
         for stream in data['streams']:
             if stream['codec_type'] == 'audio':
@@ -204,20 +473,79 @@ class MediaManager:
                     language = iso639.from_title(title)
 
                 audio_streams.append({
+                    'channels': stream.get('channels'),
                     'codec': stream['codec_name'],
                     'index': stream['index'],
                     'language': language,
                     'title': title
                 })
-            elif stream['codec_type'] == 'video' and video_codec is None:
-                video_codec = stream['codec_name']
+            elif stream['codec_type'] == 'video' and video_stream is None:
+                video_stream = stream
+
+        bit_rate = data['format'].get('bit_rate')
 
         return {
             'audio_streams': audio_streams,
+            'bit_rate': int(bit_rate) if bit_rate else None,
             'duration': float(data['format']['duration']),
-            'video_codec': video_codec
+            'frame_rate': parse_frame_rate(video_stream.get('avg_frame_rate')) if video_stream else None,
+            'video_codec': video_stream['codec_name'] if video_stream else None,
+            'video_height': video_stream.get('height') if video_stream else None,
+            'video_width': video_stream.get('width') if video_stream else None
         }
 
+    # returns the times of all keyframes of the video, reading packets without decoding them
+    def get_keyframe_times(self, filepath):
+        result = subprocess.run(["ffprobe", filepath, "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags", "-print_format", "csv=p=0"], capture_output=True, text=True)
+
+        if result.returncode != 0:
+            raise Exception("ffprobe returned non-zero exit code")
+
+        keyframe_times = list()
+
+        for line in result.stdout.splitlines():
+            [pts_time, flags] = line.split(",")[0:2]
+
+            if "K" in flags and pts_time != "N/A":
+                keyframe_times.append(float(pts_time))
+
+        keyframe_times.sort()
+
+        return keyframe_times
+
+    # builds the keyframe index of a file in the background, unless it is being built or could not be built before
+    def queue_index(self, file_id):
+        with self.lock:
+            fingerprint = self.files[file_id]['fingerprint']
+
+            if not fingerprint in self.indexing:
+                self.indexing[fingerprint] = self.index_executor.submit(self.index_file, file_id)
+
+    # builds the keyframe index of a file if it is not cached
+    #   this reads the whole file, and is only called from the index executor
+    def index_file(self, file_id):
+        with self.lock:
+            file = self.files.get(file_id)
+
+            if file is not None:
+                (fingerprint, filepath) = (file['fingerprint'], file['filepath'])
+
+        # the file was removed while waiting
+        if file is None:
+            return
+
+        if self.probe_cache.get_keyframes(fingerprint) is None:
+            LOG.info("Indexing keyframes of file '%s'", filepath)
+
+            try:
+                self.probe_cache.set_keyframes(fingerprint, self.get_keyframe_times(filepath))
+            except Exception as err:
+                LOG.warn("Could not find keyframes of file '%s': %s", filepath, err)
+                return
+
+        with self.lock:
+            self.indexing.pop(fingerprint, None)
+
     def host_file(self, file_id, audio_stream_index = None):
         if self.server is None:
             return None
@@ -230,17 +558,44 @@ class MediaManager:
         if audio_stream_index is None:
             audio_stream_index = file['audio_streams'][0]['index']
 
-        return self.server.add_item(file_id, filepath=file['filepath'], duration=file['duration'], audio_channel=audio_stream_index)
+        # chunks have a fixed layout until the keyframe index is built
+        keyframe_times = self.probe_cache.get_keyframes(file['fingerprint'])
+
+        if keyframe_times is None:
+            self.queue_index(file_id)
+
+        audio_stream = next(stream for stream in file['audio_streams'] if stream['index'] == audio_stream_index)
+
+        return self.server.add_item(file_id, filepath=file['filepath'], duration=file['duration'], audio_channel=audio_stream_index, audio_codec=audio_stream['codec'], audio_channels=audio_stream['channels'], bit_rate=file['bit_rate'], frame_rate=file['frame_rate'], video_codec=file['video_codec'], video_height=file['video_height'], video_width=file['video_width'], keyframe_times=keyframe_times)
 
 
 
 class Watcher:
-    def __init__(self, manager, origin, patterns):
+    def __init__(self, manager, origin, patterns, *, state_dir = None, ingest_delay = 5, ingest_interval = 1):
         self.manager = manager
         self.origin = origin
         self.patterns = patterns
 
-        self.filepaths = set()
+        # time during which the size and mtime of a new file must not change before it is added (in seconds)
+        self.ingest_delay = ingest_delay
+
+        # delay between two checks of pending files (in seconds)
+        self.ingest_interval = ingest_interval
+
+        self.filepaths = PathTree()
+
+        # path -> ((size, mtime) or None, time of the last change) of files waiting to be added
+        self.pending = dict()
+
+        # guards 'filepaths' and 'pending', which are modified by the observer and ingest threads
+        self.lock = threading.RLock()
+
+        self._ingest_thread = None
+        self._stop_event = threading.Event()
+
+        # directory path -> { 'mtime', 'dirs', 'files' } as of the last scan
+        self.scan_index = dict()
+        self.scan_index_path = state_dir and os.path.join(state_dir, "scan_index.json")
 
     def matches_patterns(self, filepath):
         for pattern in self.patterns:
@@ -249,12 +604,121 @@ class Watcher:
 
         return False
 
+    def load_scan_index(self):
+        try:
+            if self.scan_index_path is None:
+                raise Exception("No index path")
+
+            with open(self.scan_index_path, 'r') as file:
+                data = json.load(file)
+
+            if data.get('origin') != self.origin or data.get('patterns') != self.patterns:
+                raise Exception("Origin or patterns changed")
+
+            self.scan_index = data['directories']
+            LOG.info("Loaded scan index with %d directories", len(self.scan_index))
+        except Exception as err:
+            LOG.info("Could not load scan index: %s", err)
+
+    def save_scan_index(self):
+        if self.scan_index_path is None:
+            return
+
+        with open(self.scan_index_path, 'w') as file:
+            json.dump({
+                'directories': self.scan_index,
+                'origin': self.origin,
+                'patterns': self.patterns
+            }, file)
+
+    def scan(self):
+        """
+        Walks the tree once and returns the paths of all files matching the
+        patterns. Directories whose mtime did not change since the last scan
+        are not listed again, their entries are read from the scan index.
+        """
+
+        filepaths = list()
+        scan_index = dict()
+        listed_count = 0
+
+        dirpaths = [self.origin]
+
+        while dirpaths:
+            dirpath = dirpaths.pop()
+
+            try:
+                mtime = os.stat(dirpath).st_mtime_ns
+            except OSError:
+                continue
+
+            entry = self.scan_index.get(dirpath)
+
+            if entry is None or entry['mtime'] != mtime:
+                entry = { 'mtime': mtime, 'dirs': list(), 'files': list() }
+                listed_count += 1
+
+                try:
+                    with os.scandir(dirpath) as it:
+                        for dir_entry in it:
+                            # hidden entries are skipped, as with glob
+                            if dir_entry.name.startswith("."):
+                                continue
+
+                            try:
+                                if dir_entry.is_dir():
+                                    entry['dirs'].append(dir_entry.name)
+                                elif self.matches_patterns(dir_entry.name):
+                                    entry['files'].append(dir_entry.name)
+                            except OSError:
+                                pass
+                except OSError as err:
+                    LOG.warn("Could not list directory '%s': %s", dirpath, err)
+                    continue
+
+            scan_index[dirpath] = entry
+
+            filepaths += [os.path.join(dirpath, name) for name in entry['files']]
+            dirpaths += [os.path.join(dirpath, name) for name in reversed(entry['dirs'])]
+
+        LOG.info("Scanned %d directories, listed %d", len(scan_index), listed_count)
+
+        self.scan_index = scan_index
+        self.save_scan_index()
+
+        return filepaths
+
     def discover(self):
-        for pattern in self.patterns:
-            for filepath in glob.glob(os.path.join(self.origin, "**", pattern), recursive=True):
-                self.add_file(filepath)
+        self.load_scan_index()
+        self.rescan()
+
+    # synchronizes tracked files with the tree, e.g. after the watcher was not running
+    def rescan(self):
+        found_filepaths = self.scan()
+
+        found_filepaths_set = set(found_filepaths)
+
+        for filepath in self.filepaths:
+            if not filepath in found_filepaths_set:
+                self.remove_file(filepath)
+
+        filepaths = [filepath for filepath in found_filepaths if not filepath in self.filepaths]
+        self.filepaths.update(filepaths)
+
+        for filepath, metadata in self.manager.probe_files(filepaths):
+            if metadata is not None:
+                self.manager.add_file(filepath, metadata=metadata)
+            else:
+                self.filepaths.discard(filepath)
+
+        # only done now so that files moved while the watcher was not running can reuse their probe results
+        self.manager.probe_cache.retain(self.filepaths)
 
     def start(self):
+        self._stop_event.clear()
+        self._ingest_thread = threading.Thread(target=self.run_ingest)
+        self._ingest_thread.start()
+
         event_handler = EventHandler(self)
         self.observer = watchdog.observers.Observer()
         self.observer.schedule(event_handler, self.origin, recursive=True)
@@ -264,24 +728,144 @@ class Watcher:
         self.observer.stop()
         self.observer.join()
 
+        self._stop_event.set()
+        self._ingest_thread.join()
+
+    def queue_file(self, filepath):
+        """
+        Queues a created or modified file, which will be added once its size
+        and mtime have not changed for 'ingest_delay' seconds. Events on the
+        same path are coalesced.
+        """
+
+        if not self.matches_patterns(filepath):
+            return
+
+        with self.lock:
+            self.pending[filepath] = (None, time.time())
+
+    def run_ingest(self):
+        while not self._stop_event.wait(self.ingest_interval):
+            current_time = time.time()
+            ready_filepaths = list()
+
+            with self.lock:
+                for filepath, (identity, change_time) in list(self.pending.items()):
+                    try:
+                        stat = os.stat(filepath)
+                    except OSError:
+                        del self.pending[filepath]
+                        continue
+
+                    new_identity = (stat.st_size, stat.st_mtime_ns)
+
+                    if new_identity != identity:
+                        self.pending[filepath] = (new_identity, current_time)
+                    elif current_time - change_time >= self.ingest_delay:
+                        del self.pending[filepath]
+                        ready_filepaths.append(filepath)
+
+            for filepath in ready_filepaths:
+                # the file was modified after being added
+                if filepath in self.filepaths:
+                    # only its attributes or mtime changed, its tokens and conversions are kept
+                    if not self.manager.is_file_changed(filepath):
+                        continue
+
+                    self.remove_file(filepath)
+
+                try:
+                    self.add_file(filepath)
+                except Exception as err:
+                    LOG.warn("Could not add file '%s': %s", filepath, err)
+                    self.remove_file(filepath)
+
     def add_file(self, filepath):
         if self.matches_patterns(filepath):
-            if not filepath in self.filepaths:
+            with self.lock:
+                if filepath in self.filepaths:
+                    LOG.warn("Adding existing file at '%s'", filepath)
+                    return
+
                 self.filepaths.add(filepath)
-                self.manager.add_file(filepath)
-            else:
-                LOG.warn("Adding existing file at '%s'", filepath)
+
+            self.manager.add_file(filepath)
 
     def remove_file(self, filepath):
-        if filepath in self.filepaths:
-            self.filepaths.remove(filepath)
-            self.manager.remove_file(filepath)
-        elif self.matches_patterns(filepath):
-            LOG.warn("Removing missing file at '%s'", filepath)
+        with self.lock:
+            self.pending.pop(filepath, None)
+
+            if filepath in self.filepaths:
+                self.filepaths.remove(filepath)
+            else:
+                if self.matches_patterns(filepath):
+                    LOG.warn("Removing missing file at '%s'", filepath)
+
+                return
+
+        self.manager.remove_file(filepath)
+
+    def move_file(self, src_filepath, dest_filepath):
+        with self.lock:
+            # the file is still being written, restart waiting under its new path
+            if src_filepath in self.pending:
+                del self.pending[src_filepath]
+                self.queue_file(dest_filepath)
+                return
+
+            # the file was already moved along with its directory
+            if (not src_filepath in self.filepaths) and (dest_filepath in self.filepaths):
+                return
+
+            if not src_filepath in self.filepaths:
+                self.queue_file(dest_filepath)
+                return
+
+            self.filepaths.remove(src_filepath)
+
+            # the file replaces another tracked file
+            replaced = dest_filepath in self.filepaths
+
+            if replaced:
+                self.pending.pop(dest_filepath, None)
+                self.filepaths.remove(dest_filepath)
+
+            if not self.matches_patterns(dest_filepath):
+                moved = False
+            else:
+                self.filepaths.add(dest_filepath)
+                moved = True
+
+        if replaced:
+            self.manager.remove_file(dest_filepath)
+
+        if moved:
+            self.manager.move_file(src_filepath, dest_filepath)
+        else:
+            self.manager.remove_file(src_filepath)
 
     def remove_directory_children(self, dirpath):
-        for filepath in {filepath for filepath in self.filepaths if not os.path.relpath(filepath, dirpath).startswith("..")}:
-            self.remove_file(filepath)
+        with self.lock:
+            for filepath in list(self.pending.keys()):
+                if is_path_under(filepath, dirpath):
+                    del self.pending[filepath]
+
+            filepaths = self.filepaths.pop_under(dirpath)
+
+        for filepath in filepaths:
+            self.manager.remove_file(filepath)
+
+    def move_directory_children(self, src_dirpath, dest_dirpath):
+        with self.lock:
+            for filepath in list(self.pending.keys()):
+                if is_path_under(filepath, src_dirpath):
+                    del self.pending[filepath]
+                    self.queue_file(os.path.join(dest_dirpath, os.path.relpath(filepath, src_dirpath)))
+
+            moves = self.filepaths.move_under(src_dirpath, dest_dirpath)
+
+        for src_filepath, dest_filepath in moves:
+            self.manager.move_file(src_filepath, dest_filepath)
 
 
 class EventHandler(watchdog.events.FileSystemEventHandler):
@@ -291,7 +875,11 @@ class EventHandler(watchdog.events.FileSystemEventHandler):
 
     def on_created(self, event):
         if not event.is_directory:
-            self.watcher.add_file(event.src_path)
+            self.watcher.queue_file(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.watcher.queue_file(event.src_path)
 
     def on_deleted(self, event):
         if event.is_directory:
@@ -300,11 +888,24 @@ class EventHandler(watchdog.events.FileSystemEventHandler):
             self.watcher.remove_file(event.src_path)
 
     def on_moved(self, event):
-        if not event.is_directory:
-            self.watcher.remove_file(event.src_path)
-            self.watcher.add_file(event.dest_path)
+        if event.is_directory:
+            self.watcher.move_directory_children(event.src_path, event.dest_path)
+        else:
+            self.watcher.move_file(event.src_path, event.dest_path)
+
 
+def is_path_under(path, dirpath):
+    return not os.path.relpath(path, dirpath).startswith("..")
 
 def hash_str(value):
     return hashlib.sha256(bytes(value, 'utf-8')).hexdigest()
 
+# returns the frame rate of a fraction such as '24000/1001', or None if it is unknown
+def parse_frame_rate(value):
+    try:
+        [num, den] = value.split("/")
+        frame_rate = int(num) / int(den)
+    except (AttributeError, ValueError, ZeroDivisionError):
+        return None
+
+    return frame_rate if frame_rate > 0 else None
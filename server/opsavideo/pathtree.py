@@ -0,0 +1,129 @@
+import os
+
+
+class PathTree:
+    """
+    Set of absolute file paths stored as a tree of path components, so that
+    the files under a directory can be listed, removed or moved in time
+    proportional to their number rather than to the size of the set.
+    """
+
+    def __init__(self, paths = ()):
+        # directories are dictionaries of their children, files are None
+        self._root = dict()
+        self._size = 0
+
+        self.update(paths)
+
+    def __contains__(self, path):
+        *dir_parts, name = split_path(path)
+        node = self._find(dir_parts)
+
+        return (node is not None) and (name in node) and (node[name] is None)
+
+    def __iter__(self):
+        return iter(list(self.iter_under(os.sep)))
+
+    def __len__(self):
+        return self._size
+
+    def add(self, path):
+        *dir_parts, name = split_path(path)
+        node = self._root
+
+        for part in dir_parts:
+            node = node.setdefault(part, dict())
+
+        if not name in node:
+            node[name] = None
+            self._size += 1
+
+    def update(self, paths):
+        for path in paths:
+            self.add(path)
+
+    def discard(self, path):
+        *dir_parts, name = split_path(path)
+        node = self._find(dir_parts)
+
+        if (node is not None) and (name in node) and (node[name] is None):
+            del node[name]
+            self._size -= 1
+            self._prune(dir_parts)
+
+    def remove(self, path):
+        if not path in self:
+            raise KeyError(path)
+
+        self.discard(path)
+
+    def iter_under(self, dirpath):
+        parts = split_path(dirpath)
+        node = self._find(parts)
+
+        if node is None:
+            return
+
+        stack = [(parts, node)]
+
+        while stack:
+            parts, node = stack.pop()
+
+            for name, child in node.items():
+                if child is None:
+                    yield join_parts(parts + [name])
+                else:
+                    stack.append((parts + [name], child))
+
+    # removes and returns all files under a directory
+    def pop_under(self, dirpath):
+        filepaths = list(self.iter_under(dirpath))
+        parts = split_path(dirpath)
+
+        if filepaths and parts:
+            *parent_parts, name = parts
+            del self._find(parent_parts)[name]
+
+            self._size -= len(filepaths)
+            self._prune(parent_parts)
+        elif filepaths:
+            self._root = dict()
+            self._size = 0
+
+        return filepaths
+
+    # moves all files under 'src_dirpath' to 'dest_dirpath' and returns the (old path, new path) pairs
+    def move_under(self, src_dirpath, dest_dirpath):
+        src_prefix = join_parts(split_path(src_dirpath))
+        dest_prefix = join_parts(split_path(dest_dirpath))
+
+        moves = [(filepath, dest_prefix + filepath[len(src_prefix):]) for filepath in self.pop_under(src_dirpath)]
+
+        for old_filepath, new_filepath in moves:
+            self.add(new_filepath)
+
+        return moves
+
+    def _find(self, parts):
+        node = self._root
+
+        for part in parts:
+            node = node.get(part)
+
+            if node is None:
+                return None
+
+        return node
+
+    # removes empty directories on the path to 'parts'
+    def _prune(self, parts):
+        while parts and not self._find(parts):
+            *parts, name = parts
+            del self._find(parts)[name]
+
+
+def split_path(path):
+    return [part for part in os.path.normpath(path).split(os.sep) if part]
+
+def join_parts(parts):
+    return os.sep + os.sep.join(parts)
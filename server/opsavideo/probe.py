@@ -0,0 +1,146 @@
+import hashlib
+import json
+import logging
+import os
+
+
+LOG = logging.getLogger("opsavideo.probe")
+class ProbeCache:
+    def __init__(self, dir_path, version):
+        self.cache_path = dir_path and os.path.join(dir_path, "probe_cache.json")
+        self.version = version
+
+        # directory of keyframe indices, stored in one file per fingerprint as they are large and only read when a file is played
+        self.keyframes_path = dir_path and os.path.join(dir_path, "keyframes")
+
+        # path -> { 'identity', 'fingerprint' }
+        self.entries = dict()
+
+        # fingerprint -> probe results
+        self.metadatas = dict()
+
+    def load_cache(self):
+        try:
+            if self.cache_path is None:
+                raise Exception("No cache path")
+
+            with open(self.cache_path, 'r') as file:
+                data = json.load(file)
+
+                if data.get('version') != self.version:
+                    raise Exception("Upgrade required")
+
+                self.entries = data['data']['entries']
+                self.metadatas = data['data']['metadatas']
+                LOG.info("Loaded cache with %d entries", len(self.entries))
+
+                return True
+
+        except Exception as err:
+            LOG.info("Cound not load cache: %s", err)
+            return False
+
+    def save_cache(self):
+        if self.cache_path is None:
+            return
+
+        with open(self.cache_path, 'w') as file:
+            json.dump({
+                'data': {
+                    'entries': dict(self.entries),
+                    'metadatas': dict(self.metadatas)
+                },
+                'version': self.version
+            }, file)
+
+    # returns the fingerprint of a file, computing it only if the file changed since it was cached
+    def get_fingerprint(self, filepath):
+        identity = get_file_identity(filepath)
+        entry = self.entries.get(filepath)
+
+        if (entry is not None) and (entry['identity'] == identity):
+            return entry['fingerprint']
+
+        fingerprint = fingerprint_file(filepath)
+        self.entries[filepath] = {
+            'fingerprint': fingerprint,
+            'identity': identity
+        }
+
+        return fingerprint
+
+    def get(self, fingerprint):
+        return self.metadatas.get(fingerprint)
+
+    def set(self, fingerprint, metadata):
+        self.metadatas[fingerprint] = metadata
+
+    # returns the keyframe times of a file, or None if they are not cached
+    def get_keyframes(self, fingerprint):
+        if self.keyframes_path is None:
+            return None
+
+        try:
+            with open(os.path.join(self.keyframes_path, fingerprint + ".json"), 'r') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        return data['times'] if data.get('version') == self.version else None
+
+    def set_keyframes(self, fingerprint, keyframe_times):
+        if self.keyframes_path is None:
+            return
+
+        os.makedirs(self.keyframes_path, exist_ok=True)
+
+        with open(os.path.join(self.keyframes_path, fingerprint + ".json"), 'w') as file:
+            json.dump({
+                'times': keyframe_times,
+                'version': self.version
+            }, file)
+
+    def discard(self, filepath):
+        self.entries.pop(filepath, None)
+
+    def move(self, src_filepath, dest_filepath):
+        entry = self.entries.pop(src_filepath, None)
+
+        if entry is not None:
+            self.entries[dest_filepath] = entry
+
+    # remove entries of files which no longer exist
+    def retain(self, filepaths):
+        for filepath in set(self.entries.keys()) - set(filepaths):
+            del self.entries[filepath]
+
+        fingerprints = {entry['fingerprint'] for entry in self.entries.values()}
+
+        for fingerprint in set(self.metadatas.keys()) - fingerprints:
+            del self.metadatas[fingerprint]
+
+        if (self.keyframes_path is not None) and os.path.isdir(self.keyframes_path):
+            for filename in os.listdir(self.keyframes_path):
+                if not os.path.splitext(filename)[0] in fingerprints:
+                    os.remove(os.path.join(self.keyframes_path, filename))
+
+
+# (size, mtime, inode) of a file, as a list to match its JSON representation
+def get_file_identity(filepath):
+    stat = os.stat(filepath)
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+# hash of the size and of the first and last blocks of a file
+def fingerprint_file(filepath, block_size = 65536):
+    digest = hashlib.sha256()
+
+    with open(filepath, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        digest.update(str(size).encode("utf-8"))
+        digest.update(file.read(block_size))
+
+        if size > block_size:
+            file.seek(max(size - block_size, block_size))
+            digest.update(file.read(block_size))
+
+    return digest.hexdigest()
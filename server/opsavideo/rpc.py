@@ -4,31 +4,64 @@ import logging
 
 LOG = logging.getLogger('opsavideo.rpc')
 class Noticeboard:
+    """
+    A noticeboard holds a value which is sent to subscribers when they
+    subscribe, and again whenever it is published. Values which are
+    dictionaries can also be updated incrementally with publish_changes(), in
+    which case subscribers only receive the changed and removed entries. Every
+    publication increments the noticeboard's version so that subscribers can
+    detect missed notifications and request a resync.
+    """
+
     def __init__(self, value):
         self._value = value
+        self._version = 0
         self._subscriptions = dict()
 
     async def publish(self, value = None):
         if value is not None:
             self._value = value
 
-        for (update, remove) in self._subscriptions.values():
-            await update(value)
+        self._version += 1
+
+        for (update, change, remove) in list(self._subscriptions.values()):
+            await update(self._value, self._version)
 
     def publish_threadsafe(self, value, *, loop):
         asyncio.run_coroutine_threadsafe(self.publish(value), loop)
 
+    async def publish_changes(self, changed, removed):
+        if not changed and not removed:
+            return
+
+        self._value.update(changed)
+
+        for key in removed:
+            self._value.pop(key, None)
+
+        self._version += 1
+
+        for (update, change, remove) in list(self._subscriptions.values()):
+            await change({ 'changed': changed, 'removed': list(removed) }, self._version)
+
+    def publish_changes_threadsafe(self, changed, removed, *, loop):
+        asyncio.run_coroutine_threadsafe(self.publish_changes(changed, removed), loop)
+
     async def subscribe(self, sub_index, client):
-        (update, remove) = client
+        (update, change, remove) = client
 
         self._subscriptions[sub_index] = client
-        await update(self._value)
+        await update(self._value, self._version)
+
+    async def resync(self, sub_index):
+        (update, change, remove) = self._subscriptions[sub_index]
+        await update(self._value, self._version)
 
     def unsubscribe(self, sub_index):
         del self._subscriptions[sub_index]
 
     async def clear(self):
-        for (update, remove) in self._subscriptions.values():
+        for (update, change, remove) in self._subscriptions.values():
             await remove()
 
         self._subscriptions = dict()
@@ -82,8 +115,11 @@ class Server:
                                 'data': data
                             }))
 
-                        async def update(data):
-                            await notify({ 'type': 'update', 'data': data })
+                        async def update(data, version):
+                            await notify({ 'type': 'update', 'data': data, 'version': version })
+
+                        async def change(data, version):
+                            await notify({ 'type': 'change', 'data': data, 'version': version })
 
                         async def remove():
                             del subs[sub_index]
@@ -97,7 +133,21 @@ class Server:
                             'data': { 'index': sub_index }
                         }))
 
-                        await noticeboard.subscribe(sub_index, (update, remove))
+                        await noticeboard.subscribe(sub_index, (update, change, remove))
+
+                    elif method == 'resync':
+                        sub_index = data['index']
+                        noticeboard = subs[sub_index]
+
+                        LOG.debug("Resyncing client with noticeboard %s with subscription index %d, request index %d", noticeboard, sub_index, index)
+
+                        await outgoing(json.dumps({
+                            'kind': 'response',
+                            'index': index,
+                            'data': {}
+                        }))
+
+                        await noticeboard.resync(sub_index)
 
                     elif method == 'unsubscribe':
                         sub_index = data['index']
@@ -0,0 +1,93 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+
+LOG = logging.getLogger("opsavideo.store")
+class MetadataStore:
+    """
+    SQLite-backed store of JSON entries grouped in tables, each entry having
+    an expiration time. Entries are read from disk on first access and kept in
+    memory, writes are upserts of single entries committed by save().
+    """
+
+    def __init__(self, path, version, *, tables):
+        self.path = path
+        self.tables = tables
+        self.version = version
+
+        self._entries = {table: dict() for table in tables}
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+
+        self._setup()
+
+    def _setup(self):
+        with self._lock:
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+
+            if row is not None and row[0] != self.version:
+                LOG.info("Dropping store with version %s", row[0])
+
+                for table in self.tables:
+                    self._db.execute(f"DROP TABLE IF EXISTS {table}")
+
+            for table in self.tables:
+                self._db.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, data TEXT NOT NULL, expiration_time INTEGER NOT NULL)")
+                self._db.execute(f"CREATE INDEX IF NOT EXISTS {table}_expiration ON {table} (expiration_time)")
+
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (self.version,))
+            self._db.commit()
+
+    def get(self, table, key):
+        entries = self._entries[table]
+
+        if key in entries:
+            return entries[key]
+
+        with self._lock:
+            row = self._db.execute(f"SELECT data FROM {table} WHERE key = ?", (key,)).fetchone()
+
+        value = json.loads(row[0]) if row is not None else None
+        entries[key] = value
+
+        return value
+
+    def set(self, table, key, value, *, expiration_time):
+        self._entries[table][key] = value
+
+        with self._lock:
+            self._db.execute(f"INSERT OR REPLACE INTO {table} (key, data, expiration_time) VALUES (?, ?, ?)", (key, json.dumps(value), expiration_time))
+
+    def count(self, table):
+        with self._lock:
+            return self._db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    # deletes all entries which expired, returns the number of deleted entries
+    def evict_expired(self, current_time = None):
+        if current_time is None:
+            current_time = time.time()
+
+        count = 0
+
+        with self._lock:
+            for table in self.tables:
+                count += self._db.execute(f"DELETE FROM {table} WHERE expiration_time <= ?", (current_time,)).rowcount
+                self._entries[table].clear()
+
+            self._db.commit()
+
+        return count
+
+    def save(self):
+        with self._lock:
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
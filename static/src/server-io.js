@@ -141,7 +141,9 @@ export default class ServerIO {
       index: null,
       subscribeRequest: null,
       unsubscribeRequest: null,
+      resyncing: false,
       value: null,
+      version: null,
 
       subscribe: async () => {
         let request = this.request('subscribe', data);
@@ -181,8 +183,38 @@ export default class ServerIO {
 
         this._subscriptions.delete(sub);
       },
-      update: (value) => {
+      resync: async () => {
+        sub.resyncing = true;
+        sub.version = null;
+
+        try {
+          await this.request('resync', { index: sub.index }).getResponse();
+        } catch (err) {
+          sub.resyncing = false;
+        }
+      },
+      change: ({ changed, removed }, version) => {
+        // a notification was missed, request the full value again
+        if (sub.version === null || version !== sub.version + 1) {
+          if (!sub.resyncing) {
+            sub.resync();
+          }
+
+          return;
+        }
+
+        let value = { ...sub.value, ...changed };
+
+        for (let key of removed) {
+          delete value[key];
+        }
+
+        sub.update(value, version);
+      },
+      update: (value, version) => {
+        sub.resyncing = false;
         sub.value = value;
+        sub.version = version;
         handlers.update(value);
 
         if (readyDeferred) {
@@ -268,13 +300,17 @@ export default class ServerIO {
 
       switch (kind) {
         case 'notification': {
-          let { data, type } = payload.data;
+          let { data, type, version } = payload.data;
           let sub = this._subscriptionsMap.get(index);
 
           if (sub && sub.status === 'subscribed') {
             switch (type) {
               case 'update':
-                sub.update(data);
+                sub.update(data, version);
+                break;
+
+              case 'change':
+                sub.change(data, version);
                 break;
 
               case 'remove':